@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 # coding: UTF-8
 
+import threading
+import pathlib
+import json
 import sys
 import time
 import pycurl
 import requests
 
+from collections import OrderedDict
 from itertools import count
 
 # RPC interface for Bitcoin type nodes
 
-from slickrpc import Proxy
+from slickrpc import Proxy, MultiProxy, RpcStats
 from slickrpc import exc
 
 # RPC interface for Monero type nodes
@@ -43,6 +47,15 @@ class cryptoNodeException(Exception):
 
 class cryptoNode():
 
+	# Seconds for which idempotent query results are reused - all are dropped on a new block
+
+	cache_ttl = {'getblockcount'         : 10,
+				 'getconnectioncount'    : 10,
+				 'getwalletinfo'         :  2,
+				 'getbalance'            : 60,
+				 'getunlockedbalance'    : 60,
+				 'getunconfirmedbalance' : 10}
+
 	############################################################################
 
 	def __init__(self, symbol, rpc_address, rpc_user, rpc_pass):
@@ -61,6 +74,12 @@ class cryptoNode():
 
 		self.no_refresh  = False	# Used by owner to suppress refresh() calls during sync/catchup
 
+		self.aproxy      = None		# Non-blocking RPC proxy, once attached to an event loop
+		self.event_loop  = None		# Owning event loop - blocking calls are moved onto its worker pool
+
+		self.cache       = {}		# method -> (expiry, result) for methods in cache_ttl
+		self.cache_gen   = 0		# Bumped on invalidation - results fetched before then are not stored
+
 	############################################################################
 
 	def __getattr__(self, method):
@@ -75,12 +94,80 @@ class cryptoNode():
 
 	############################################################################
 
+	def cache_lookup(self, method):
+
+		entry = self.cache.get(method)
+
+		if entry and entry[0] > time.monotonic():
+
+			return entry[1]
+
+		return None
+
+	############################################################################
+
+	def cache_store(self, method, result, generation = None):
+
+		# generation is cache_gen captured when the fetch started - a stale fetch is returned but not cached
+
+		if generation is None or generation == self.cache_gen:
+
+			self.cache[method] = (time.monotonic() + self.cache_ttl[method], result)
+
+		return result
+
+	############################################################################
+
+	def cached_call(self, method, fetch):
+
+		result = self.cache_lookup(method)
+
+		if result is None:
+
+			generation = self.cache_gen
+
+			result = self.cache_store(method, fetch(), generation)
+
+		return result
+
+	############################################################################
+
+	def invalidate_cache(self, *methods):
+
+		# Called with no arguments on a new block, or with the methods a wallet operation has made stale
+
+		self.cache_gen += 1
+
+		if methods:
+
+			for method in methods:
+
+				self.cache.pop(method, None)
+
+		else:
+
+			self.cache.clear()
+
+	############################################################################
+
 	def refresh(self):
 
 		raise NotImplementedError
 
 	############################################################################
 
+	def set_blocks(self, blocks):
+
+		# A polled change of height stands in for the block notification that nodes without zmq never get
+
+		if self.blocks and blocks != self.blocks:
+
+			self.invalidate_cache(*[method for method in self.cache_ttl if method not in ('getblockcount', 'getconnectioncount')])
+
+		self.blocks = blocks
+
+	############################################################################
+
 	def get_balance(self):
 
 		raise NotImplementedError
@@ -99,6 +186,93 @@ class cryptoNode():
 
 	############################################################################
 
+	def attach_event_loop(self, loop):
+
+		self.event_loop = loop
+
+	############################################################################
+
+	def call_async(self, callback, function, *args):
+
+		# callback(result, error) on the loop thread - runs inline when no event loop is attached
+		# Errors are caught as broadly as the worker pool catches them so callbacks see the same behaviour
+
+		if self.event_loop:
+
+			self.event_loop.run_in_worker(callback, function, *args)
+
+			return
+
+		try:
+
+			result = function(*args)
+
+		except Exception as error:
+
+			callback(None, error)
+
+		else:
+
+			callback(result, None)
+
+	############################################################################
+
+	def get_balances_async(self, callback):
+
+		# callback((confirmed, unlocked, unconfirmed), error) - nodes without an async proxy use the worker pool
+
+		if not self.aproxy:
+
+			self.call_async(callback, lambda: (self.get_balance(), self.get_unlocked_balance(), self.get_unconfirmed_balance()))
+
+			return
+
+		balance     = self.cache_lookup('getbalance')
+		unconfirmed = self.cache_lookup('getunconfirmedbalance')
+
+		if balance is not None and unconfirmed is not None:
+
+			callback((balance, balance, unconfirmed), None)
+
+			return
+
+		generation = self.cache_gen
+
+		futures = [self.aproxy.getbalance(), self.aproxy.getunconfirmedbalance()]
+
+		def on_done(future):
+
+			if all(f.done() for f in futures):
+
+				try:
+
+					balance, unconfirmed = [f.result() for f in futures]
+
+					self.cache_store('getbalance', balance, generation)
+					self.cache_store('getunconfirmedbalance', unconfirmed, generation)
+
+				except exc.RpcException as error:
+
+					callback(None, cryptoNodeException('{} daemon returned error: {}'.format(self.symbol, str(error))))
+
+				except pycurl.error:
+
+					callback(None, cryptoNodeException('Failed to connect - check that {} daemon is running'.format(self.symbol)))
+
+				except ValueError:
+
+					callback(None, cryptoNodeException('Failed to connect - error in rpcuser or rpcpassword for {} daemon'.format(self.symbol)))
+
+				else:
+
+					callback((balance, balance, unconfirmed), None)
+
+		for future in futures:
+
+			future.add_done_callback(on_done)
+
+	############################################################################
+
 	def get_new_address(self):
 
 		raise NotImplementedError
@@ -145,6 +319,18 @@ class eccoinNode(cryptoNode):
 
 	version_fPacketSig = 30300
 
+	rpc_connections = 8 # Upper bound on concurrent RPC calls across all threads
+
+	route_ttl          = 300	# Seconds a found route is trusted
+	route_refresh_age  = 150	# Age after which a found route is re-checked in the background
+	route_negative_ttl = 10		# Seconds an unreachable routing tag is remembered
+	route_cache_size   = 4096	# Routing tags remembered - least recently checked evicted first
+
+	tagsDomain   = 'ecchat.io'
+	tagsFilePath = 'net'
+	tagsFileName = 'ecresolve-tags.json'
+	tagsMinTTL   = 60			# Floor on the TXT record TTL used for cache expiry
+
 	serviceIdx = count(start=1)
 	respondIdx = count(start=1)
 
@@ -154,8 +340,9 @@ class eccoinNode(cryptoNode):
 
 		super().__init__(symbol, rpc_address, rpc_user, rpc_pass)
 
-		self.proxy = Proxy('http://%s:%s@%s' % (rpc_user, rpc_pass, rpc_address)) # Not thread safe ...
-		self.prox2 = Proxy('http://%s:%s@%s' % (rpc_user, rpc_pass, rpc_address)) # ... hence needing 2
+		self.rpc_url = 'http://%s:%s@%s' % (rpc_user, rpc_pass, rpc_address)
+
+		self.proxy = Proxy(self.rpc_url, max_connections = self.rpc_connections) # Thread safe - pooled connections
 
 		self.serviceId  = service_id
 		self.respondId  = respond_id
@@ -166,6 +353,12 @@ class eccoinNode(cryptoNode):
 
 		self.ecresolve_tags = []
 
+		# Route cache : routing tag -> (time checked, route available)
+
+		self.routes            = OrderedDict()
+		self.routes_lock       = threading.Lock()
+		self.routes_refreshing = set()
+
 		# ECC feature flags (based on version number)
 
 		self.fPacketSig = False
@@ -182,6 +375,16 @@ class eccoinNode(cryptoNode):
 
 	############################################################################
 
+	def attach_event_loop(self, loop):
+
+		super().attach_event_loop(loop)
+
+		self.aproxy = MultiProxy(self.rpc_url, max_connections = self.rpc_connections)
+
+		self.aproxy.attach(loop)
+
+	############################################################################
+
 	def initialise(self):
 
 		try:
@@ -256,22 +459,22 @@ class eccoinNode(cryptoNode):
 
 		# Load ecresolve routing tags and setup routes for subsequent ecc network name resolution
 
-		self.ecresolve_tags = self.get_ecresolve_tags()
+		self.ecresolve_tags, stale = self.get_ecresolve_tags()
 
-		route = []
+		if stale: # Started only once the cached tags are assigned so the refresh is never overwritten
 
-		for tag in self.ecresolve_tags:
+			threading.Thread(target = self.refresh_ecresolve_tags, daemon = True).start()
 
-			try:
-
-				self.proxy.findroute(tag)
+		route = []
 
-				route.append(self.proxy.haveroute(tag))
+		for tag, isRoute in zip(self.ecresolve_tags, self.find_routes(self.ecresolve_tags)):
 
-			except exc.RpcInvalidAddressOrKey:
+			if isRoute is None:
 
 				raise cryptoNodeException('Routing tag for ecresolve has invalid base64 encoding : {}'.format(tag))
 
+			route.append(isRoute)
+
 		if not any(route):
 
 			raise cryptoNodeException('No route available to ecresolve across all {} configured routing tags'.format(len(self.ecresolve_tags)))
@@ -280,26 +483,42 @@ class eccoinNode(cryptoNode):
 
 	def refresh(self):
 
-		self.blocks = self.proxy.getblockcount()
-		self.peers  = self.proxy.getconnectioncount()
+		blocks = self.cache_lookup('getblockcount')
+		peers  = self.cache_lookup('getconnectioncount')
+
+		if blocks is None or peers is None:
+
+			generation = self.cache_gen
+
+			with self.proxy.batch() as batch:
+
+				blocks = batch.getblockcount()
+				peers  = batch.getconnectioncount()
+
+			blocks = self.cache_store('getblockcount',      blocks.result(), generation)
+			peers  = self.cache_store('getconnectioncount', peers.result(),  generation)
+
+		self.set_blocks(blocks)
+
+		self.peers  = peers
 
 	############################################################################
 
 	def get_balance(self):
 
-		return self.proxy.getbalance()
+		return self.cached_call('getbalance', self.proxy.getbalance)
 
 	############################################################################
 
 	def get_unlocked_balance(self):
 
-		return self.proxy.getbalance()
+		return self.cached_call('getbalance', self.proxy.getbalance)
 
 	############################################################################
 
 	def get_unconfirmed_balance(self):
 
-		return self.proxy.getunconfirmedbalance()
+		return self.cached_call('getunconfirmedbalance', self.proxy.getunconfirmedbalance)
 
 	############################################################################
 
@@ -311,7 +530,7 @@ class eccoinNode(cryptoNode):
 
 	def wallet_locked(self, cache_prior_state = False):
 
-		info = self.proxy.getwalletinfo()
+		info = self.cached_call('getwalletinfo', self.proxy.getwalletinfo)
 
 		if cache_prior_state and info.keys() >= {'unlocked_until', 'staking_only_unlock'}:
 
@@ -343,6 +562,8 @@ class eccoinNode(cryptoNode):
 
 		else:
 
+			self.invalidate_cache('getwalletinfo')
+
 			# Cache passphrase for later call to revert_wallet_lock
 
 			if self.cached_prior_walletinfo:
@@ -369,6 +590,11 @@ class eccoinNode(cryptoNode):
 
 	def send_to_address(self, address, amount, comment):
 
+		# Invalidated before the send so fetches already in flight are not stored, and again once it returns
+		# as a balance fetched on another worker while the send ran may predate it
+
+		self.invalidate_cache('getbalance', 'getunconfirmedbalance', 'getwalletinfo')
+
 		try:
 
 			txid = self.proxy.sendtoaddress(address, amount, comment)
@@ -393,6 +619,10 @@ class eccoinNode(cryptoNode):
 
 			return txid
 
+		finally:
+
+			self.invalidate_cache('getbalance', 'getunconfirmedbalance', 'getwalletinfo')
+
 	############################################################################
 
 	def reset_service_buffer_timeout(self):
@@ -401,9 +631,9 @@ class eccoinNode(cryptoNode):
 
 			try:
 
-				bufferSig = self.prox2.buffersignmessage(self.serviceKey, 'ResetBufferTimeout')
+				bufferSig = self.proxy.buffersignmessage(self.serviceKey, 'ResetBufferTimeout')
 
-				self.prox2.resetbuffertimeout(self.serviceId, bufferSig)
+				self.proxy.resetbuffertimeout(self.serviceId, bufferSig)
 
 			except pycurl.error:
 
@@ -423,9 +653,9 @@ class eccoinNode(cryptoNode):
 
 			try:
 
-				bufferSig = self.prox2.buffersignmessage(self.respondKey, 'ResetBufferTimeout')
+				bufferSig = self.proxy.buffersignmessage(self.respondKey, 'ResetBufferTimeout')
 
-				self.prox2.resetbuffertimeout(self.respondId, bufferSig)
+				self.proxy.resetbuffertimeout(self.respondId, bufferSig)
 
 			except pycurl.error:
 
@@ -441,17 +671,76 @@ class eccoinNode(cryptoNode):
 
 	def reset_buffer_timeouts(self):
 
-		serviceResult = self.reset_service_buffer_timeout()
+		buffers = [(bufferId, bufferKey) for bufferId, bufferKey in ((self.serviceId, self.serviceKey), (self.respondId, self.respondKey)) if bufferKey]
+
+		if not buffers:
 
-		respondResult = self.reset_respond_buffer_timeout()
+			return False
+
+		# Both signatures in one round trip, then both resets in another
+
+		try:
+
+			with self.proxy.batch() as batch:
+
+				bufferSigs = [batch.buffersignmessage(bufferKey, 'ResetBufferTimeout') for bufferId, bufferKey in buffers]
 
-		return serviceResult or respondResult # OR semantics because the return value is used to gate timer setup
+			with self.proxy.batch() as batch:
+
+				resets = [batch.resetbuffertimeout(bufferId, bufferSig.result()) for (bufferId, bufferKey), bufferSig in zip(buffers, bufferSigs)]
+
+			for reset in resets:
+
+				reset.result()
+
+		except pycurl.error:
+
+			self.serviceKey = ''
+
+			raise cryptoNodeException('Failed to connect - check that eccoin daemon is running')
+
+		return True # True when any buffer is registered because the return value is used to gate timer setup
+
+	############################################################################
+
+	def get_rpc_stats(self, reset = False):
+
+		# Per-method snapshot of RPC stats - calls made via the async proxy are prefixed 'async:'
+
+		snapshot = self.proxy.stats.snapshot(reset)
+
+		if self.aproxy:
+
+			for method, stats in self.aproxy.stats.snapshot(reset).items():
+
+				snapshot['async:' + method] = stats
+
+		return snapshot
+
+	############################################################################
+
+	def get_rpc_stats_lines(self, reset = False):
+
+		return RpcStats.format_snapshot(self.get_rpc_stats(reset))
 
 	############################################################################
 
 	def get_ecresolve_tags(self):
 
-		domain = 'ecchat.io'
+		# Returns (tags, stale) - tags cached on disk are used immediately, stale once expired
+		# so the caller can refresh them from DNS in the background
+
+		tags, expires = self.load_ecresolve_tags()
+
+		if tags:
+
+			return tags, expires <= time.time()
+
+		return self.resolve_ecresolve_tags(), False
+
+	############################################################################
+
+	def resolve_ecresolve_tags(self):
 
 		# TODO - Make this daemon version dependent ref new RPC
 
@@ -459,11 +748,11 @@ class eccoinNode(cryptoNode):
 
 		try:
 
-			resolved = dns.resolver.resolve(domain, 'TXT')
+			resolved = dns.resolver.resolve(self.tagsDomain, 'TXT')
 
 		except:
 
-			raise cryptoNodeException('Error while resolving ecresolve routing tags from {} TXT record'.format(domain))
+			raise cryptoNodeException('Error while resolving ecresolve routing tags from {} TXT record'.format(self.tagsDomain))
 
 		for entry in resolved:
 
@@ -473,19 +762,178 @@ class eccoinNode(cryptoNode):
 
 				tags.append(decoded_entry[1])
 
+		if tags:
+
+			self.save_ecresolve_tags(tags, time.time() + max(resolved.rrset.ttl, self.tagsMinTTL))
+
 		return tags
 
 	############################################################################
 
-	def setup_route(self, targetRoute):
+	def refresh_ecresolve_tags(self):
+
+		try:
+
+			tags = self.resolve_ecresolve_tags()
+
+		except cryptoNodeException:
+
+			return # DNS unavailable - keep using the cached tags
+
+		if tags and tags != self.ecresolve_tags:
+
+			newTags = [tag for tag in tags if tag not in self.ecresolve_tags]
+
+			self.ecresolve_tags = tags
+
+			try:
+
+				self.find_routes(newTags)
+
+			except (exc.RpcException, pycurl.error, ValueError):
+
+				pass # routes are found again by setup_route when used
+
+	############################################################################
+
+	def load_ecresolve_tags(self):
+
+		filePath = pathlib.Path(self.tagsFilePath) / self.tagsFileName
+
+		try:
+
+			with open(filePath, 'r') as f:
+
+				cached = json.load(f)
+
+			return [str(tag) for tag in cached['tags']], float(cached['expires'])
+
+		except (OSError, ValueError, KeyError, TypeError):
+
+			return [], 0.0
+
+	############################################################################
+
+	def save_ecresolve_tags(self, tags, expires):
+
+		filePath = pathlib.Path(self.tagsFilePath) / self.tagsFileName
+
+		tempPath = filePath.with_suffix('.tmp')
+
+		try:
+
+			pathlib.Path(self.tagsFilePath).mkdir(parents=True, exist_ok=True)
+
+			with open(tempPath, 'w') as f:
+
+				json.dump({'expires' : expires, 'tags' : tags}, f)
+
+			tempPath.replace(filePath)
+
+		except OSError:
+
+			pass # cache is an optimisation only
+
+	############################################################################
+
+	def find_routes(self, targetRoutes):
+
+		# Daemon executes a batch in order, so each findroute precedes its haveroute
+		# Returns True/False per routing tag, or None for a tag with invalid encoding
+
+		with self.proxy.batch() as batch:
+
+			calls = [(batch.findroute(tag), batch.haveroute(tag)) for tag in targetRoutes]
+
+		results = []
+
+		for tag, (find, have) in zip(targetRoutes, calls):
+
+			try:
+
+				find.result()
+
+				isRoute = bool(have.result())
+
+			except exc.RpcInvalidAddressOrKey:
+
+				isRoute = None
+
+			else:
+
+				self.store_route(tag, isRoute)
+
+			results.append(isRoute)
+
+		return results
+
+	############################################################################
+
+	def store_route(self, targetRoute, isRoute):
+
+		with self.routes_lock:
+
+			self.routes[targetRoute] = (time.monotonic(), isRoute)
+
+			self.routes.move_to_end(targetRoute)
+
+			while len(self.routes) > self.route_cache_size:
+
+				self.routes.popitem(last = False)
+
+	############################################################################
+
+	def refresh_route(self, targetRoute):
 
 		try:
 
-			self.proxy.findroute(targetRoute)
+			self.find_routes([targetRoute])
+
+		except (exc.RpcException, pycurl.error, ValueError):
+
+			with self.routes_lock:
+
+				self.routes.pop(targetRoute, None)
+
+		finally:
+
+			with self.routes_lock:
+
+				self.routes_refreshing.discard(targetRoute)
+
+	############################################################################
+
+	def setup_route(self, targetRoute):
+
+		with self.routes_lock:
+
+			checked, isRoute = self.routes.get(targetRoute, (None, False))
+
+			age = time.monotonic() - checked if checked is not None else None
+
+			refresh = isRoute and age is not None and self.route_refresh_age <= age < self.route_ttl and targetRoute not in self.routes_refreshing
+
+			if refresh:
+
+				self.routes_refreshing.add(targetRoute)
 
-			isRoute = self.proxy.haveroute(targetRoute)
+		if age is not None:
 
-		except exc.RpcInvalidAddressOrKey:
+			if isRoute and age < self.route_ttl:
+
+				if refresh: # Route still usable - re-check it off the caller's thread
+
+					threading.Thread(target = self.refresh_route, args = (targetRoute,), daemon = True).start()
+
+				return
+
+			if not isRoute and age < self.route_negative_ttl:
+
+				raise cryptoNodeException('No route available to : {}'.format(targetRoute))
+
+		isRoute = self.find_routes([targetRoute])[0]
+
+		if isRoute is None:
 
 			raise cryptoNodeException('Routing tag has invalid base64 encoding : {}'.format(targetRoute))
 
@@ -559,24 +1007,87 @@ class eccoinNode(cryptoNode):
 
 	############################################################################
 
-	def shutdown(self):
+	def get_buffer_async(self, protocol_id, callback):
 
-		if self.serviceKey:
+		# callback(eccbuffer, error) - falls back to get_buffer() when no async proxy is attached
 
-			bufferSig = self.proxy.buffersignmessage(self.serviceKey, 'ReleaseBufferRequest')
+		if not self.aproxy:
 
-			self.proxy.releasebuffer(self.serviceId, bufferSig)
+			try:
 
-			self.serviceKey = ''
+				eccbuffer = self.get_buffer(protocol_id)
 
-		if self.respondKey:
+			except (exc.RpcException, pycurl.error) as error:
+
+				callback(None, error)
+
+			else:
+
+				callback(eccbuffer, None)
+
+			return
+
+		if protocol_id == self.serviceId and self.serviceKey:
+
+			bufferKey = self.serviceKey
+			bufferCmd = 'GetBufferRequest:' + str(self.serviceId) + str(next(self.serviceIdx))
+
+		elif protocol_id == self.respondId and self.respondKey:
+
+			bufferKey = self.respondKey
+			bufferCmd = 'GetBufferRequest:' + str(self.respondId) + str(next(self.respondIdx))
+
+		else:
+
+			callback(None, None)
+
+			return
+
+		def on_buffer(future):
+
+			if future.exception():
+
+				callback(None, future.exception())
+
+			else:
+
+				callback(future.result(), None)
+
+		def on_signed(future):
+
+			if future.exception():
+
+				callback(None, future.exception())
+
+			else:
+
+				self.aproxy.getbuffer(protocol_id, future.result()).add_done_callback(on_buffer)
+
+		self.aproxy.buffersignmessage(bufferKey, bufferCmd).add_done_callback(on_signed)
+
+	############################################################################
+
+	def shutdown(self):
+
+		buffers = [(bufferId, bufferKey) for bufferId, bufferKey in ((self.serviceId, self.serviceKey), (self.respondId, self.respondKey)) if bufferKey]
+
+		if buffers:
+
+			with self.proxy.batch() as batch:
 
-			bufferSig = self.proxy.buffersignmessage(self.respondKey, 'ReleaseBufferRequest')
+				bufferSigs = [batch.buffersignmessage(bufferKey, 'ReleaseBufferRequest') for bufferId, bufferKey in buffers]
 
-			self.proxy.releasebuffer(self.respondId, bufferSig)
+			with self.proxy.batch() as batch:
 
+				releases = [batch.releasebuffer(bufferId, bufferSig.result()) for (bufferId, bufferKey), bufferSig in zip(buffers, bufferSigs)]
+
+			self.serviceKey = ''
 			self.respondKey = ''
 
+			for release in releases:
+
+				release.result()
+
 ################################################################################
 ## bitcoinNode class ###########################################################
 ################################################################################
@@ -589,7 +1100,9 @@ class bitcoinNode(cryptoNode):
 
 		super().__init__(symbol, rpc_address, rpc_user, rpc_pass)
 
-		self.proxy = Proxy('http://%s:%s@%s' % (rpc_user, rpc_pass, rpc_address))
+		self.rpc_url = 'http://%s:%s@%s' % (rpc_user, rpc_pass, rpc_address)
+
+		self.proxy = Proxy(self.rpc_url)
 
 	############################################################################
 
@@ -599,6 +1112,16 @@ class bitcoinNode(cryptoNode):
 
 	############################################################################
 
+	def attach_event_loop(self, loop):
+
+		super().attach_event_loop(loop)
+
+		self.aproxy = MultiProxy(self.rpc_url)
+
+		self.aproxy.attach(loop)
+
+	############################################################################
+
 	def initialise(self):
 
 		try:
@@ -642,9 +1165,25 @@ class bitcoinNode(cryptoNode):
 	############################################################################
 
 	def refresh(self):
-		
-		self.blocks = self.proxy.getblockcount()
-		self.peers  = self.proxy.getconnectioncount()
+
+		blocks = self.cache_lookup('getblockcount')
+		peers  = self.cache_lookup('getconnectioncount')
+
+		if blocks is None or peers is None:
+
+			generation = self.cache_gen
+
+			with self.proxy.batch() as batch:
+
+				blocks = batch.getblockcount()
+				peers  = batch.getconnectioncount()
+
+			blocks = self.cache_store('getblockcount',      blocks.result(), generation)
+			peers  = self.cache_store('getconnectioncount', peers.result(),  generation)
+
+		self.set_blocks(blocks)
+
+		self.peers  = peers
 
 	############################################################################
 
@@ -652,7 +1191,7 @@ class bitcoinNode(cryptoNode):
 
 		try:
 
-			result = self.proxy.getbalance()
+			result = self.cached_call('getbalance', self.proxy.getbalance)
 
 		except exc.RpcException as error:
 
@@ -668,7 +1207,7 @@ class bitcoinNode(cryptoNode):
 
 		try:
 
-			result = self.proxy.getbalance()
+			result = self.cached_call('getbalance', self.proxy.getbalance)
 
 		except exc.RpcException as error:
 
@@ -684,7 +1223,7 @@ class bitcoinNode(cryptoNode):
 
 		try:
 
-			result = self.proxy.getunconfirmedbalance()
+			result = self.cached_call('getunconfirmedbalance', self.proxy.getunconfirmedbalance)
 
 		except exc.RpcException as error:
 
@@ -704,7 +1243,7 @@ class bitcoinNode(cryptoNode):
 
 	def wallet_locked(self, cache_prior_state = False):
 
-		info = self.proxy.getwalletinfo()
+		info = self.cached_call('getwalletinfo', self.proxy.getwalletinfo)
 
 		if 'unlocked_until' in info:
 
@@ -726,6 +1265,8 @@ class bitcoinNode(cryptoNode):
 
 		else:
 
+			self.invalidate_cache('getwalletinfo')
+
 			return True
 
 	############################################################################
@@ -738,6 +1279,11 @@ class bitcoinNode(cryptoNode):
 
 	def send_to_address(self, address, amount, comment):
 
+		# Invalidated before the send so fetches already in flight are not stored, and again once it returns
+		# as a balance fetched on another worker while the send ran may predate it
+
+		self.invalidate_cache('getbalance', 'getunconfirmedbalance', 'getwalletinfo')
+
 		try:
 
 			txid = self.proxy.sendtoaddress(address, amount, comment)
@@ -762,6 +1308,10 @@ class bitcoinNode(cryptoNode):
 
 			return txid
 
+		finally:
+
+			self.invalidate_cache('getbalance', 'getunconfirmedbalance', 'getwalletinfo')
+
 	############################################################################
 
 	def shutdown(self):
@@ -828,7 +1378,7 @@ class moneroNode(cryptoNode):
 
 		try:
 
-			self.blocks = self.wallet.height()
+			self.set_blocks(self.wallet.height())
 
 		except monero.backends.jsonrpc.exceptions.Unauthorized:
 
@@ -856,18 +1406,24 @@ class moneroNode(cryptoNode):
 
 	def get_balance(self):
 
-		return self.wallet.balance()
+		return self.cached_call('getbalance', self.wallet.balance)
 
 	############################################################################
 
 	def get_unlocked_balance(self):
 
-		return self.wallet.balance(unlocked=True)
+		return self.cached_call('getunlockedbalance', lambda: self.wallet.balance(unlocked=True))
 
 	############################################################################
 
 	def get_unconfirmed_balance(self):
 
+		return self.cached_call('getunconfirmedbalance', self.fetch_unconfirmed_balance)
+
+	############################################################################
+
+	def fetch_unconfirmed_balance(self):
+
 		amount = 0.0
 
 		transfers = self.wallet._backend.transfers_in(0, PaymentFilter(unconfirmed=True, confirmed=False))
@@ -908,7 +1464,18 @@ class moneroNode(cryptoNode):
 
 	def send_to_address(self, address, amount, comment):
 
-		return self.wallet.transfer(address, float(amount))[0].hash
+		# Invalidated before the send so fetches already in flight are not stored, and again once it returns
+		# as a balance fetched on another worker while the send ran may predate it
+
+		self.invalidate_cache('getbalance', 'getunlockedbalance', 'getunconfirmedbalance')
+
+		try:
+
+			return self.wallet.transfer(address, float(amount))[0].hash
+
+		finally:
+
+			self.invalidate_cache('getbalance', 'getunlockedbalance', 'getunconfirmedbalance')
 
 	############################################################################
 
@@ -14,6 +14,7 @@ import zmq
 import sys
 import re
 
+from functools import partial
 from uuid import uuid4
 
 # ZMQ event loop adapter for urwid
@@ -29,7 +30,7 @@ from configure import loadConfigurationECC, loadConfigurationAlt
 
 # eccPacket, cryptoNode & transaction classes
 
-from eccpacket    import eccPacket
+from eccpacket    import eccPacket, eccPacketException, eccPeers
 from cryptonode   import cryptoNode, eccoinNode, bitcoinNode, moneroNode, cryptoNodeException
 from transactions import txChat, txSend, txReceive
 
@@ -63,7 +64,7 @@ class ChatApp:
 
 	############################################################################
 
-	def __init__(self, name, conf, debug=False):
+	def __init__(self, name, conf, debug=False, slow=0.1):
 
 		urwid.set_encoding('utf-8')
 
@@ -76,6 +77,8 @@ class ChatApp:
 
 		self.conf     = conf
 		self.debug    = debug
+		self.slow     = slow
+		self.peers    = eccPeers()
 
 		self.exitMsg  = ''
 
@@ -91,6 +94,8 @@ class ChatApp:
 
 		self.subscribers = []
 
+		self.buffer_fetching = {}	# protocolID : refetch flag - one buffer fetch in flight per protocol id
+
 		self.coins = []
 
 		self.txChat    = None
@@ -186,27 +191,27 @@ class ChatApp:
 
 			if self.debug:
 
-				logging.info('TX({}): {}'.format(eccPacket._protocol_id_ecchat, ecc_packet.to_json()))
+				logging.info('TX({}): {}'.format(eccPacket._protocol_id_ecchat, ecc_packet.encode(eccPacket.compact_for(self.txChat.tag, self.peers))))
 
-			ecc_packet.send(self.coins[0])
+			ecc_packet.send(self.coins[0], self.peers)
 
 	############################################################################
 
 	def send_ecresolve_packet(self, meth, data):
 
-		for tag in self.coins[0].ecresolve_tags:
+		ecc_packet = eccPacket(eccPacket._protocol_id_ecresolve,
+			                   self.coins[0].respondId, '',
+			                   self.coins[0].routingTag,
+			                   meth,
+			                   data)
 
-			ecc_packet = eccPacket(eccPacket._protocol_id_ecresolve,
-				                   self.coins[0].respondId, tag,
-				                   self.coins[0].routingTag, 
-				                   meth, 
-				                   data)
+		if self.debug:
 
-			if self.debug:
+			for tag in self.coins[0].ecresolve_tags:
 
-				logging.info('TX({}): {}'.format(eccPacket._protocol_id_ecresolve, ecc_packet.to_json()))
+				logging.info('TX({}): {}'.format(eccPacket._protocol_id_ecresolve, ecc_packet.encode_for(tag, eccPacket.compact_for(tag, self.peers))))
 
-			ecc_packet.send(self.coins[0])
+		ecc_packet.send_fanout(self.coins[0], self.coins[0].ecresolve_tags, self.peers)
 
 	############################################################################
 
@@ -312,6 +317,10 @@ class ChatApp:
 
 	def block_refresh(self, index):
 
+		# New block - cached balances, counts and wallet state are all stale
+
+		self.coins[index].invalidate_cache()
+
 		if not self.coins[index].no_refresh:
 
 			self.coins[index].refresh()
@@ -338,13 +347,27 @@ class ChatApp:
 
 	############################################################################
 
+	def set_timeout(self, seconds, callback):
+
+		# Protocol timeouts go on the event loop timing wheel - callbacks keep the urwid alarm signature
+
+		return self.event_loop.set_timeout(seconds, callback, self.loop, None)
+
+	############################################################################
+
+	def cancel_timeout(self, handle):
+
+		return self.event_loop.cancel_timeout(handle)
+
+	############################################################################
+
 	def start_swap(self, amountGive, indexGive, amountTake, indexTake):
 
 		# Check 1 - Is a swap currently pending ?
 
 		if self.swap_pending:
 
-			self.loop.remove_alarm(self.swap_timeout_h)
+			self.cancel_timeout(self.swap_timeout_h)
 
 			self.swap_pending    = False
 			self.swap_uuid       = ''
@@ -375,9 +398,19 @@ class ChatApp:
 
 			return
 
-		# Check 4 - Does the user's wallet hold an adequate balance ?
+		# Check 4 - Does the user's wallet hold an adequate balance ? (continues off the event loop)
 
-		balance = self.coins[indexGive].get_unlocked_balance()
+		self.coins[indexGive].call_async(partial(self.start_swap_balance, float_amountGive, indexGive, float_amountTake, indexTake), self.coins[indexGive].get_unlocked_balance)
+
+	############################################################################
+
+	def start_swap_balance(self, float_amountGive, indexGive, float_amountTake, indexTake, balance, error):
+
+		if error:
+
+			self.append_message(0, str(error))
+
+			return
 
 		if float_amountGive >= balance:
 
@@ -399,7 +432,7 @@ class ChatApp:
 
 		self.send_ecchat_packet(eccPacket.METH_swapInf, data)
 
-		handle = self.loop.set_alarm_in(60, self.timeout_swap)
+		handle = self.set_timeout(60, self.timeout_swap)
 
 		self.swap_pending    = True
 		self.swap_uuid       = data['uuid']
@@ -467,9 +500,19 @@ class ChatApp:
 
 			return
 
-		# Check 5 - Does the user's wallet hold an adequate balance ?
+		# Check 5 - Does the user's wallet hold an adequate balance ? (continues off the event loop)
 
-		balance = self.coins[indexTake].get_unlocked_balance()
+		self.coins[indexTake].call_async(partial(self.swap_proposed_balance, float_amountGive, indexGive, float_amountTake, indexTake), self.coins[indexTake].get_unlocked_balance)
+
+	############################################################################
+
+	def swap_proposed_balance(self, float_amountGive, indexGive, float_amountTake, indexTake, balance, error):
+
+		if error:
+
+			self.append_message(0, str(error))
+
+			return
 
 		if float_amountTake >= balance:
 
@@ -499,7 +542,21 @@ class ChatApp:
 
 			return
 
-		address = self.coins[self.swap_indexGive].get_new_address()
+		self.coins[self.swap_indexGive].call_async(self.swap_execute_address, self.coins[self.swap_indexGive].get_new_address)
+
+	############################################################################
+
+	def swap_execute_address(self, address, error):
+
+		if error:
+
+			self.append_message(0, str(error))
+
+			return
+
+		if not self.swap_pending:
+
+			return
 
 		data = {'uuid' : self.swap_uuid,
 				'cogv' : self.coins[self.swap_indexGive].symbol,
@@ -507,25 +564,17 @@ class ChatApp:
 
 		self.send_ecchat_packet(eccPacket.METH_swapReq, data)
 
-		self.loop.set_alarm_in(10, self.timeout_execute)
+		self.set_timeout(10, self.timeout_execute)
 
 	############################################################################
 
 	def swap_request(self, symbolGive, addressGive):
 
-		if self.swap_pending:
-
-			assert symbolGive == self.coins[self.swap_indexGive].symbol
+		if self.swap_pending and symbolGive == self.coins[self.swap_indexGive].symbol:
 
 			self.swap_addressGive = addressGive
 
-			address = self.coins[self.swap_indexTake].get_new_address()
-
-			data = {'uuid' : self.swap_uuid,
-					'cotk' : self.coins[self.swap_indexTake].symbol,
-					'adtk' : address}
-
-			self.send_ecchat_packet(eccPacket.METH_swapRes, data)
+			self.coins[self.swap_indexTake].call_async(self.swap_request_address, self.coins[self.swap_indexTake].get_new_address)
 
 		else:
 
@@ -537,6 +586,24 @@ class ChatApp:
 
 	############################################################################
 
+	def swap_request_address(self, address, error):
+
+		if not self.swap_pending:
+
+			return # Swap timed out or completed while the address was fetched
+
+		if error:
+
+			self.append_message(0, str(error))
+
+		data = {'uuid' : self.swap_uuid,
+				'cotk' : self.coins[self.swap_indexTake].symbol,
+				'adtk' : '0' if error else address}
+
+		self.send_ecchat_packet(eccPacket.METH_swapRes, data)
+
+	############################################################################
+
 	def swap_response(self, symbolTake, addressTake):
 
 		if addressTake == '0':
@@ -545,9 +612,7 @@ class ChatApp:
 
 			#TODO : Test this !!!
 
-		if self.swap_pending and addressTake != '0':
-
-			assert symbolTake == self.coins[self.swap_indexTake].symbol
+		if self.swap_pending and addressTake != '0' and symbolTake == self.coins[self.swap_indexTake].symbol:
 
 			try:
 
@@ -709,18 +774,22 @@ class ChatApp:
 
 	def echo_balance(self, coin):
 
-		try:
+		# Balances are fetched without blocking the event loop where the node supports it
 
-			balance_con = coin.get_balance()
-			balance_unl = coin.get_unlocked_balance()
-			balance_unc = coin.get_unconfirmed_balance()
+		coin.get_balances_async(partial(self.echo_balance_result, coin))
 
-		except cryptoNodeException as error:
+	############################################################################
+
+	def echo_balance_result(self, coin, balances, error):
+
+		if error:
 
 			self.append_message(0, str(error))
 
 		else:
 
+			balance_con, balance_unl, balance_unc = balances
+
 			if balance_con != balance_unl:
 
 				if balance_unc > 0:
@@ -1104,21 +1173,59 @@ class ChatApp:
 
 	def process_packet_notification(self, protocolID):
 
-		eccbuffer = self.coins[0].get_buffer(protocolID)
+		# getbuffer returns every queued packet so a notification arriving mid fetch only needs one more fetch
+
+		if protocolID in self.buffer_fetching:
+
+			self.buffer_fetching[protocolID] = True
+
+			return
+
+		self.buffer_fetching[protocolID] = False
+
+		self.coins[0].get_buffer_async(protocolID, partial(self.process_ecc_buffer, protocolID))
+
+	############################################################################
+
+	def process_ecc_buffer(self, protocolID, eccbuffer, error):
+
+		try:
+
+			if error:
+
+				logging.info('RX({}): Buffer fetch failed : {}'.format(protocolID, str(error)))
+
+			elif eccbuffer:
+
+				for packet in eccbuffer.values():
+
+					message = codecs.decode(packet, 'hex').decode()
+
+					if self.debug:
+
+						logging.info('RX({}): {}'.format(protocolID, message))
+
+					try:
+
+						ecc_packet = eccPacket.from_json(message)
 
-		if eccbuffer:
+					except eccPacketException as error:
 
-			for packet in eccbuffer.values():
+						logging.info('RX({}): Packet rejected : {}'.format(protocolID, str(error)))
 
-				message = codecs.decode(packet, 'hex').decode()
+						continue
 
-				if self.debug:
+					self.peers.record(ecc_packet)
 
-					logging.info('RX({}): {}'.format(protocolID, message))
+					self.process_ecc_packet(ecc_packet)
 
-				ecc_packet = eccPacket.from_json(message)
+		finally:
 
-				self.process_ecc_packet(ecc_packet)
+			# Release the fetch slot even if a packet handler fails
+
+			if self.buffer_fetching.pop(protocolID, False):
+
+				self.process_packet_notification(protocolID)
 
 	############################################################################
 
@@ -1166,13 +1273,7 @@ class ChatApp:
 
 			if valid:
 
-				address = self.coins[index].get_new_address()
-
-				rData = {'uuid' : data['uuid'],
-						 'coin' : data['coin'],
-						 'addr' : address}
-
-				self.send_ecchat_packet(eccPacket.METH_addrRes, rData)
+				self.coins[index].call_async(partial(self.send_address_response, data['uuid'], data['coin']), self.coins[index].get_new_address)
 
 		elif ecc_packet.get_meth() == eccPacket.METH_addrRes:
 
@@ -1320,10 +1421,26 @@ class ChatApp:
 
 	############################################################################
 
+	def send_address_response(self, uuid, coin, address, error):
+
+		# An address of '0' tells the sender we are unable to receive
+
+		if error:
+
+			logging.info('Address request for {} failed : {}'.format(coin, str(error)))
+
+		rData = {'uuid' : uuid,
+				 'coin' : coin,
+				 'addr' : '0' if error else address}
+
+		self.send_ecchat_packet(eccPacket.METH_addrRes, rData)
+
+	############################################################################
+
 	def zmqInitialise(self):
 
 		self.context    = zmq.Context()
-		self.event_loop = zmqEventLoop()
+		self.event_loop = zmqEventLoop(self.slow)
 
 		for index, coin in enumerate(self.coins):
 
@@ -1336,29 +1453,53 @@ class ChatApp:
 
 				self.event_loop.watch_queue(self.subscribers[index], self.zmqHandler, zmq.POLLIN, index)
 
+			coin.attach_event_loop(self.event_loop)
+
 	############################################################################
 
 	def zmqHandler(self, index):
 
+		# Drain the socket in one pass - a block storm costs one refresh and a packet burst one fetch per protocol id
+
+		messages = self.event_loop.drain_queue(self.subscribers[index])
+
 		if index > 0: # various chains return differing numbers of list values (ltc = 3)
 
-			slashdevslashnull = self.subscribers[index].recv_multipart(zmq.DONTWAIT)
+			if messages:
 
-			self.block_refresh(index)
+				self.block_refresh(index)
 
 			return
 
-		# TODO : Note this can occasionally return an array of tuples causing a crash on Windows
+		hashblock = False
+
+		protocols = []
+
+		for message in messages:
+
+			# TODO : Note this can occasionally return an array of tuples causing a crash on Windows
+
+			[address, contents] = message[:2]
+
+			if address.decode() == 'hashblock':
+
+				hashblock = True
 
-		[address, contents] = self.subscribers[index].recv_multipart(zmq.DONTWAIT)
-		
-		if address.decode() == 'hashblock':
+			if address.decode() == 'packet':
+
+				protocolID = int(contents.decode()[1:])
+
+				if protocolID not in protocols:
+
+					protocols.append(protocolID)
+
+		if hashblock:
 
 			self.block_refresh(0)
 
-		if address.decode() == 'packet':
+		for protocolID in protocols:
 
-			self.process_packet_notification(int(contents.decode()[1:]))
+			self.process_packet_notification(protocolID)
 
 	############################################################################
 
@@ -1455,6 +1596,12 @@ class ChatApp:
 
 			self.loop.run()
 
+			self.event_loop.shutdown_workers()
+
+			for line in self.event_loop.monitor.snapshot_lines():
+
+				logging.info('Loop stats : {}'.format(line))
+
 			self.zmqShutdown()
 
 		self.cryptoShutdown()
@@ -1499,6 +1646,7 @@ def main():
 	argparser.add_argument('-n', '--name'  , action='store',      help='chat name'          , type=str, default = ''           , required=True )
 	argparser.add_argument('-c', '--conf'  , action='store',      help='configuration file' , type=str, default = 'ecchat.conf', required=False)
 	argparser.add_argument('-d', '--debug' , action='store_true', help='debug message log'  ,                                    required=False)
+	argparser.add_argument('-t', '--slow'  , action='store',      help='slow callback log threshold seconds', type=float, default = 0.1, required=False)
 
 	command_line_args = argparser.parse_args()
 
@@ -1506,7 +1654,8 @@ def main():
 
 	app = ChatApp(command_line_args.name,
 	              command_line_args.conf,
-	              command_line_args.debug)
+	              command_line_args.debug,
+	              command_line_args.slow)
 
 	app.run()
 
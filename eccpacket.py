@@ -1,8 +1,26 @@
 #!/usr/bin/env python3
 # coding: UTF-8
 
+import threading
+import binascii
+import struct
 import json
 
+from collections import OrderedDict
+from uuid import UUID
+
+################################################################################
+## eccPacketException class ####################################################
+################################################################################
+
+class eccPacketException(Exception):
+
+	############################################################################
+
+	def __init__(self, message):
+
+		super().__init__(message)
+
 ################################################################################
 ## eccPacket class #############################################################
 ################################################################################
@@ -14,7 +32,21 @@ class eccPacket():
 	_protocol_id_ecresolve   = 2
 	_protocol_id_ectranslate = 3
 
-	_protocol_versions_by_id = [0,1,1,1]
+	_protocol_versions_by_id = [0,2,2,2]
+	_protocol_versions_compact = [0,2,2,2] # minimum version by id understanding the compact encoding
+
+	# Compact encoding : '#' + base64( header | to | from | data fields | extra data )
+
+	_compact_prefix = '#'
+
+	_compact_header = struct.Struct('>BHHB')	# ver, sid, rid, meth code
+	_compact_length = struct.Struct('>H')
+	_compact_field  = struct.Struct('>BH')		# field type, field length
+
+	_field_text = 0
+	_field_tag  = 1
+	_field_uuid = 2
+	_field_json = 3
 
 	METH_chatReq = 'chatReq'
 	METH_chatRes = 'chatRes'
@@ -29,6 +61,8 @@ class eccPacket():
 	METH_nameAdv = 'nameAdv'
 	METH_nameReq = 'nameReq'
 	METH_nameRes = 'nameRes'
+	METH_nameReqBatch = 'nameReqBatch'
+	METH_nameResBatch = 'nameResBatch'
 
 	METH_SET = [METH_chatReq,
 				METH_chatRes,
@@ -42,7 +76,9 @@ class eccPacket():
 				METH_swapRes,
 				METH_nameAdv,
 				METH_nameReq,
-				METH_nameRes]
+				METH_nameRes,
+				METH_nameReqBatch,
+				METH_nameResBatch]
 
 	KEY_LIST = {METH_chatReq : ('uuid', 'cmmd', 'name'),
 				METH_chatRes : ('uuid', 'cmmd', 'name'),
@@ -56,17 +92,26 @@ class eccPacket():
 				METH_swapRes : ('uuid', 'cotk', 'adtk'),
 				METH_nameAdv : ('uuid', 'name', 'type'),
 				METH_nameReq : ('uuid', 'name', 'type'),
-				METH_nameRes : ('uuid', 'name', 'type', 'tags')}
+				METH_nameRes : ('uuid', 'name', 'type', 'tags'),
+				METH_nameReqBatch : ('uuid', 'type', 'names'),
+				METH_nameResBatch : ('uuid', 'type', 'names', 'tags')}
+
+	# Validator table compiled once at import : meth -> required key set
+
+	KEY_SETS = {meth : frozenset(keys) for meth, keys in KEY_LIST.items()}
+
+	# Compact encoding method codes - new methods must be appended to METH_SET
+
+	METH_CODES = {meth : code for code, meth in enumerate(METH_SET, start = 1)}
+	METH_NAMES = {code : meth for meth, code in METH_CODES.items()}
 
 	############################################################################
 
 	def __init__(self, _sid = 0, _rid = 0, _to = '', _from = '', _meth = '', _data = ''):
 
-		assert isinstance(_data, dict)
-
-		assert _meth in self.METH_SET
+		self.validate_header(_sid, _rid, _to, _from)
 
-		assert all(key in _data for key in self.KEY_LIST[_meth])
+		self.validate(_meth, _data)
 
 		self.packet = {	'ver'	: self._protocol_versions_by_id[_sid],
 						'sid'	: _sid,
@@ -76,29 +121,342 @@ class eccPacket():
 						'meth'	: _meth,
 						'data'	: _data}
 
+		self._encoded   = {}	# compact flag -> memoized encoding
+		self._templates = {}	# compact flag -> encoding split either side of 'to'
+
+	############################################################################
+
+	@classmethod
+
+	def validate_header(cls, sid, rid, to, frm):
+
+		# bool is an int subclass but never a valid protocol id
+
+		if type(sid) is not int or sid not in range(len(cls._protocol_versions_by_id)):
+
+			raise eccPacketException('Packet service protocol id unknown : {}'.format(sid))
+
+		# rid may be an ephemeral response id so is only bounded by the 16 bit compact header field
+
+		if type(rid) is not int or rid not in range(1 << 16):
+
+			raise eccPacketException('Packet response protocol id invalid : {}'.format(rid))
+
+		if not isinstance(to, str) or not isinstance(frm, str):
+
+			raise eccPacketException('Packet routing tags are not strings')
+
+	############################################################################
+
+	@classmethod
+
+	def validate(cls, meth, data):
+
+		if not isinstance(data, dict):
+
+			raise eccPacketException('Packet data is not a JSON object : {}'.format(meth))
+
+		try:
+
+			keys = cls.KEY_SETS[meth]
+
+		except (KeyError, TypeError):
+
+			raise eccPacketException('Packet method unknown : {}'.format(meth))
+
+		if not keys <= data.keys():
+
+			raise eccPacketException('Packet data missing keys for {} : {}'.format(meth, ', '.join(sorted(keys - data.keys()))))
+
 	############################################################################
 
 	@classmethod
 
 	def from_json(cls, json_string = ''):
 
-		d = json.loads(json_string)
+		if json_string[:1] == cls._compact_prefix:
+
+			return cls.from_compact(json_string)
+
+		try:
+
+			d = json.loads(json_string)
+
+		except ValueError:
+
+			raise eccPacketException('Packet is not valid JSON')
+
+		if not isinstance(d, dict):
+
+			raise eccPacketException('Packet is not a JSON object')
+
+		try:
+
+			if 'id' in d: # Back compatible crash prevention
+
+				ecc_packet = cls(d['id'],  d['id'],  d['to'], d['from'], d['meth'], d['data'])
+
+			else:
 
-		# TOTO : Implement comprehensive key presence checks
+				ecc_packet = cls(d['sid'], d['rid'], d['to'], d['from'], d['meth'], d['data'])
 
-		if 'id' in d: # Back compatible crash prevention
+		except KeyError as error:
 
-			return cls(d['id'],  d['id'],  d['to'], d['from'], d['meth'], d['data'])
+			raise eccPacketException('Packet header missing key : {}'.format(error))
+
+		except TypeError:
+
+			raise eccPacketException('Packet header has invalid types')
+
+		ecc_packet.set_peer_ver(d.get('ver', 0))
+
+		return ecc_packet
+
+	############################################################################
+
+	@classmethod
+
+	def from_compact(cls, compact_string = ''):
+
+		try:
+
+			frame = binascii.a2b_base64(compact_string[1:])
+
+			ver, sid, rid, code = cls._compact_header.unpack_from(frame, 0)
+
+			offset = cls._compact_header.size
+
+			meth = cls.METH_NAMES[code]
+
+			to_tag,   offset = cls._unpack_field(frame, offset)
+			from_tag, offset = cls._unpack_field(frame, offset)
+
+			data = {}
+
+			for key in cls.KEY_LIST[meth]:
+
+				data[key], offset = cls._unpack_field(frame, offset)
+
+			extra, offset = cls._unpack_field(frame, offset)
+
+			if extra:
+
+				if not isinstance(extra, dict):
+
+					raise eccPacketException('Packet compact extra data is not a JSON object')
+
+				data.update(extra)
+
+			ecc_packet = cls(sid, rid, to_tag, from_tag, meth, data)
+
+		except KeyError:
+
+			raise eccPacketException('Packet method code unknown : {}'.format(code))
+
+		except (binascii.Error, struct.error, ValueError):
+
+			raise eccPacketException('Packet compact encoding is malformed')
+
+		ecc_packet.set_peer_ver(ver)
+
+		return ecc_packet
+
+	############################################################################
+
+	@classmethod
+
+	def _pack_field(cls, value, tag = False):
+
+		if isinstance(value, str):
+
+			if tag and len(value) == 88:
+
+				try:
+
+					raw = binascii.a2b_base64(value)
+
+				except binascii.Error:
+
+					raw = b''
+
+				if len(raw) == 64 and binascii.b2a_base64(raw, newline = False).decode() == value:
+
+					return cls._compact_field.pack(cls._field_tag, len(raw)) + raw
+
+			elif len(value) == 36:
+
+				try:
+
+					uuid = UUID(value)
+
+				except ValueError:
+
+					uuid = None
+
+				if uuid and str(uuid) == value:
+
+					return cls._compact_field.pack(cls._field_uuid, 16) + uuid.bytes
+
+			raw = value.encode()
+
+			field_type = cls._field_text
 
 		else:
 
-			return cls(d['sid'], d['rid'], d['to'], d['from'], d['meth'], d['data'])
+			raw = json.dumps(value, separators = (',', ':')).encode()
+
+			field_type = cls._field_json
+
+		return cls._compact_field.pack(field_type, len(raw)) + raw
+
+	############################################################################
+
+	@classmethod
+
+	def _unpack_field(cls, frame, offset):
+
+		field_type, length = cls._compact_field.unpack_from(frame, offset)
+
+		offset += cls._compact_field.size
+
+		raw = frame[offset:offset + length]
+
+		if len(raw) != length:
+
+			raise ValueError('truncated field')
+
+		offset += length
+
+		if field_type == cls._field_text:
+
+			return raw.decode(), offset
+
+		if field_type == cls._field_tag:
+
+			return binascii.b2a_base64(raw, newline = False).decode(), offset
+
+		if field_type == cls._field_uuid:
+
+			return str(UUID(bytes = raw)), offset
+
+		if field_type == cls._field_json:
+
+			return json.loads(raw), offset
+
+		raise ValueError('unknown field type')
+
+	############################################################################
+
+	def set_peer_ver(self, ver):
+
+		# Received packets carry the sending peer's 'ver' rather than our own
+
+		self.packet['ver'] = ver
+
+		self._encoded.clear()
+		self._templates.clear()
+
+	############################################################################
+
+	def accepts_compact(self):
+
+		# True when the sender's 'ver' shows it is able to receive the compact encoding
+
+		ver = self.packet['ver']
+
+		return type(ver) is int and ver >= self._protocol_versions_compact[self.packet['sid']] > 0
+
+	############################################################################
+
+	@staticmethod
+
+	def compact_for(dest_key, peers):
+
+		return peers is not None and dest_key in peers
 
 	############################################################################
 
 	def to_json(self):
 
-		return json.dumps(self.packet)
+		return self.encode(compact = False)
+
+	############################################################################
+
+	def to_compact(self):
+
+		return self.encode(compact = True)
+
+	############################################################################
+
+	def encode(self, compact = False):
+
+		# Encoded once on first use and memoized - the packet is immutable once built
+
+		if compact not in self._encoded:
+
+			self._encoded[compact] = self.encode_for(self.packet['to'], compact)
+
+		return self._encoded[compact]
+
+	############################################################################
+
+	def encode_for(self, dest_key, compact = False):
+
+		# Encode with dest_key spliced in as 'to', reusing the cached encoding of every other field
+
+		if compact:
+
+			try:
+
+				head, tail = self._template(compact = True)
+
+			except struct.error:
+
+				compact = False # field too large for the compact encoding - fall back to JSON
+
+			else:
+
+				return self._compact_prefix + binascii.b2a_base64(head + self._pack_field(dest_key, tag = True) + tail, newline = False).decode()
+
+		head, tail = self._template(compact = False)
+
+		return head + json.dumps(dest_key) + tail
+
+	############################################################################
+
+	def _template(self, compact):
+
+		# Encoded packet split either side of the 'to' field
+
+		if compact not in self._templates:
+
+			if compact:
+
+				meth = self.packet['meth']
+				data = self.packet['data']
+
+				fields = [self._pack_field(self.packet['from'], tag = True)]
+
+				for key in self.KEY_LIST[meth]:
+
+					fields.append(self._pack_field(data[key]))
+
+				extra = {key : value for key, value in data.items() if key not in self.KEY_SETS[meth]}
+
+				fields.append(self._pack_field(extra) if extra else self._compact_field.pack(self._field_text, 0))
+
+				head = self._compact_header.pack(self.packet['ver'], self.packet['sid'], self.packet['rid'], self.METH_CODES[meth])
+
+				self._templates[compact] = (head, b''.join(fields))
+
+			else:
+
+				head = json.dumps({key : self.packet[key] for key in ('ver', 'sid', 'rid')})
+				tail = json.dumps({key : self.packet[key] for key in ('from', 'meth', 'data')})
+
+				self._templates[compact] = (head[:-1] + ', "to": ', ', ' + tail[1:])
+
+		return self._templates[compact]
 
 	############################################################################
 
@@ -140,32 +498,90 @@ class eccPacket():
 
 	def get_data(self):
 
-		data = self.packet['data']
+		return self.packet['data'] # validated once on construction
 
-		assert isinstance(data, dict)
+	############################################################################
 
-		assert self.packet['meth'] in self.METH_SET
+	# peers is the sending app's eccPeers - the compact encoding is used for destinations known to accept it
 
-		assert all(key in data for key in self.KEY_LIST[self.packet['meth']])
+	def send(self, proxy, peers = None):
 
-		return data
+		proxy.send_packet(self.packet['to'], self.packet['sid'], self.encode(self.compact_for(self.packet['to'], peers)))
 
 	############################################################################
 
-	def send(self, proxy):
+	def send_fanout(self, proxy, dest_keys, peers = None):
+
+		# Send the same packet to each of dest_keys, splicing only the 'to' field per destination
+
+		for dest_key in dest_keys:
 
-		proxy.send_packet(self.packet['to'], self.packet['sid'], json.dumps(self.packet))
+			proxy.send_packet(dest_key, self.packet['sid'], self.encode_for(dest_key, self.compact_for(dest_key, peers)))
 
 	############################################################################
 
-	def send_response(self, proxy):
+	def send_response(self, proxy, peers = None):
 
 		if self.packet['rid'] == 0:
 
-			proxy.send_packet(self.packet['to'], self.packet['sid'], json.dumps(self.packet))
+			proxy.send_packet(self.packet['to'], self.packet['sid'], self.encode(self.compact_for(self.packet['to'], peers)))
 
 		else:
 
-			proxy.send_packet(self.packet['to'], self.packet['rid'], json.dumps(self.packet))
+			proxy.send_packet(self.packet['to'], self.packet['rid'], self.encode(self.compact_for(self.packet['to'], peers)))
+
+################################################################################
+## eccPeers class ##############################################################
+################################################################################
+
+class eccPeers():
+
+	# Routing tags of peers known to accept the compact encoding - learnt from the 'ver' of received packets
+	# Owned by each app and bounded in LRU order, as the 'from' field is unauthenticated
+	# Recorded on the loop thread and read by senders on worker threads, hence the lock
+
+	############################################################################
+
+	def __init__(self, limit = 10000):
+
+		self.limit = limit
+		self.tags  = OrderedDict()
+		self.lock  = threading.Lock()
+
+	############################################################################
+
+	def record(self, ecc_packet):
+
+		tag = ecc_packet.get_from()
+
+		with self.lock:
+
+			if ecc_packet.accepts_compact():
+
+				self.tags[tag] = True
+
+				self.tags.move_to_end(tag)
+
+				if len(self.tags) > self.limit:
+
+					self.tags.popitem(last = False)
+
+			else:
+
+				self.tags.pop(tag, None)
+
+	############################################################################
+
+	def __contains__(self, tag):
+
+		with self.lock:
+
+			return tag in self.tags
+
+	############################################################################
+
+	def __len__(self):
+
+		return len(self.tags)
 
 ################################################################################
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # coding: UTF-8
 
-import threading
+import functools
 import datetime
 import argparse
 import pathlib
@@ -11,6 +11,7 @@ import signal
 import codecs
 import pickle
 import zmq
+import os
 import sys
 
 from uuid import uuid4
@@ -21,20 +22,24 @@ from configure import loadConfigurationECC
 
 # eccPacket & cryptoNode  classes
 
-from eccpacket    import eccPacket
+from eccpacket    import eccPacket, eccPacketException, eccPeers
 from cryptonode   import cryptoNode, eccoinNode, cryptoNodeException
 
-################################################################################
-## RepeatTimer class ###########################################################
-################################################################################
+# Constant memory unique user counting
+
+from hyperloglog  import HyperLogLog
 
-class RepeatTimer(threading.Timer):
+# Exact hash set on disk - append only journal compacted into a sorted, memory mapped index
 
-    def run(self):
+from hashstore    import HashStore
 
-        while not self.finished.wait(self.interval):
+# Per sender token bucket admission control
 
-            self.function(*self.args, **self.kwargs)
+from ratelimit    import RateLimiter, rate_spec
+
+# Single threaded event loop - timers, zmq and a worker pool for blocking work
+
+from zmqeventloop import zmqEventLoop
 
 ################################################################################
 ## UsageTrack class ############################################################
@@ -47,39 +52,62 @@ class UsageTrack:
 
 	############################################################################
 
-	def __init__(self):
+	def __init__(self, exact = False):
 
 		pathlib.Path(self.usageFilePath).mkdir(parents=True, exist_ok=True)
 
 		self.filePath  = pathlib.Path(self.usageFilePath) / self.usageFileName
+		self.hllPath   = self.filePath.with_suffix('.hll')
+
+		# Unique users are estimated in constant memory - the exact hash set is optional
 
-		self.tagHashes = self.loadListFile(self.filePath)
+		self.exact     = exact
 
 		self.changed   = False
 
+		self.tagHashes = self.openStore() if exact else None
+
+		self.counter   = self.loadCounter(self.hllPath)
+
+		self.saving    = False
+
 	############################################################################
 
-	def start(self):
+	def start(self, loop):
 
-		self.buffer_timer = RepeatTimer(10, self.saveIfNecessary)
+		self.loop = loop
 
-		self.buffer_timer.start()
+		self.buffer_timer = loop.set_interval(10, self.saveIfNecessary)
 
 	############################################################################
 
 	def stop(self):
 
-		self.buffer_timer.cancel()
+		# Loop has stopped - final save is made synchronously
+
+		self.loop.cancel_interval(self.buffer_timer)
+
+		if self.changed:
+
+			work = self.tagHashes.take_batch() if self.exact else None
+
+			self.saveComplete(self.saveFiles(work, self.counter.to_bytes()), None, work)
+
+		if self.exact:
+
+			self.tagHashes.close()
 
 	############################################################################
 
 	def usageByTag(self, tag):
 
-		tagHash = hashlib.sha256(tag.encode()).hexdigest()
+		tagHash = hashlib.sha256(tag.encode())
+
+		if self.counter.add_hash(tagHash.digest()):
 
-		if tagHash not in self.tagHashes:
+			self.changed = True
 
-			self.tagHashes.append(tagHash)
+		if self.exact and self.tagHashes.add(tagHash.digest()):
 
 			self.changed = True
 
@@ -87,49 +115,136 @@ class UsageTrack:
 
 	def count(self):
 
-		return len(self.tagHashes)
+		if self.exact:
+
+			return len(self.tagHashes)
+
+		return int(round(self.counter.count()))
 
 	############################################################################
 
 	def saveIfNecessary(self):
 
-		if self.changed:
+		# Only hashes added since the last save are appended, on the worker pool - one save in flight keeps writes ordered
 
-			self.saveListFile(self.tagHashes, self.filePath)
+		if self.changed and not self.saving:
+
+			self.saving  = True
 
 			self.changed = False
 
+			work = self.tagHashes.take_batch() if self.exact else None
+
+			self.loop.run_in_worker(functools.partial(self.saveComplete, work = work), self.saveFiles, work, self.counter.to_bytes())
+
 	############################################################################
 
-	def loadListFile(self, filePath = ''):
+	def saveComplete(self, result, error, work = None):
 
-		nullList = []
+		self.saving = False
 
-		if not pathlib.Path(filePath).is_file():
+		if error:
+
+			logging.info('UsageTrack : Save failed : {}'.format(str(error)))
 
-			with open(filePath, 'wb') as f:
+			if work:
 
-				pickle.dump(nullList, f)
+				self.tagHashes.write_failed(work)
 
-				f.close()
+			self.changed = True
 
-				return nullList
+		elif work:
 
-		else:
+			self.tagHashes.compacted(result)
+
+	############################################################################
+
+	def saveFiles(self, work, counter):
+
+		# Registers are written to a temporary file and renamed so a crash never leaves a torn file
+
+		temp = self.hllPath.with_suffix('.tmp')
+
+		with open(temp, 'wb') as f:
+
+			f.write(counter)
 
-			with open(filePath, 'rb') as f:
+		os.replace(temp, self.hllPath)
 
-				return pickle.load(f)
+		if work:
+
+			return self.tagHashes.write_batch(work)
+
+		return None
 
 	############################################################################
 
-	def saveListFile(self, list = [], filePath = ''):
+	def loadCounter(self, filePath):
+
+		if pathlib.Path(filePath).is_file():
+
+			try:
+
+				with open(filePath, 'rb') as f:
+
+					return HyperLogLog.from_bytes(f.read())
 
-		with open(filePath, 'wb') as f:
+			except (OSError, IndexError, ValueError) as error:
 
-			pickle.dump(list, f)
+				logging.info('UsageTrack : Counter unreadable, reseeding : {}'.format(str(error)))
 
-			f.close()
+		counter = HyperLogLog()
+
+		# First run with the estimator, or an unreadable counter - seed it from the exact hashes held
+
+		if self.tagHashes is not None:
+
+			for tagHash in self.tagHashes:
+
+				counter.add_hash(tagHash)
+
+			self.changed = True
+
+		elif pathlib.Path(self.filePath).is_file():
+
+			for tagHash in self.loadListFile(self.filePath):
+
+				counter.add_hash(bytes.fromhex(tagHash))
+
+			self.changed = True
+
+		return counter
+
+	############################################################################
+
+	def openStore(self):
+
+		# Exact hashes live in an append only journal compacted into a sorted index
+		# First run with the store - migrate the old pickled hash list into the index
+
+		store = HashStore(self.filePath.with_suffix(''))
+
+		if not len(store) and pathlib.Path(self.filePath).is_file():
+
+			for tagHash in self.loadListFile(self.filePath):
+
+				store.add(bytes.fromhex(tagHash))
+
+			store.compacted(store.write_batch(store.take_batch(True)))
+
+		return store
+
+	############################################################################
+
+	def loadListFile(self, filePath = ''):
+
+		if not pathlib.Path(filePath).is_file():
+
+			return []
+
+		with open(filePath, 'rb') as f:
+
+			return pickle.load(f)
 
 ################################################################################
 ## EchoApp class ###############################################################
@@ -137,18 +252,34 @@ class UsageTrack:
 
 class EchoApp:
 
-	def __init__(self, protocol, name, prefix, debug=False):
+	# Default per sender limits as (packets per second, burst) - each packet costs daemon RPCs
+
+	defaultRates = {eccPacket.METH_chatMsg : (2.0, 10.0),
+					eccPacket.METH_chatReq : (1.0,  5.0),
+					eccPacket.METH_addrReq : (1.0,  5.0)}
+
+	otherRate    = (5.0, 20.0)
+
+	def __init__(self, protocol, name, prefix, debug=False, stats=300, slow=0.1, workers=4, exact_usage=False, rates=()):
 
 		self.name			= name
 		self.prefix			= prefix
 		self.debug			= debug
+		self.stats			= stats
+		self.workers		= workers
+		self.event_loop		= zmqEventLoop(slow, name = name, lanes = workers)
 		self.subscribers	= []
 		self.coins			= []
-		self.running		= True
-		self.buffer_timer   = 0
-		self.chatname_timer = 0
+		self.peers			= eccPeers()
+		self.buffer_timer   = None
+		self.chatname_timer = None
+		self.stats_timer    = None
+
+		self.buffer_fetching = {}	# protocolID : refetch flag
+
+		self.usageTrack		= UsageTrack(exact_usage)
 
-		self.usageTrack		= UsageTrack()
+		self.rateLimiter	= RateLimiter(name, dict(self.defaultRates, **{meth : (rate, burst) for meth, rate, burst in rates}), self.otherRate)
 
 	############################################################################
 
@@ -158,23 +289,23 @@ class EchoApp:
 
 		if self.debug:
 
-			logging.info('TX({}): {}'.format(eccPacket._protocol_id_ecchat, ecc_packet.to_json()))
+			logging.info('TX({}): {}'.format(eccPacket._protocol_id_ecchat, ecc_packet.encode(eccPacket.compact_for(dest, self.peers))))
 
-		ecc_packet.send(self.coins[0])
+		ecc_packet.send(self.coins[0], self.peers)
 
 	############################################################################
 
 	def send_ecresolve_packet(self, meth, data):
 
-		for tag in self.coins[0].ecresolve_tags:
+		ecc_packet = eccPacket(eccPacket._protocol_id_ecresolve, 0, '', self.coins[0].routingTag, meth, data)
 
-			ecc_packet = eccPacket(eccPacket._protocol_id_ecresolve, 0, tag, self.coins[0].routingTag, meth, data)
+		if self.debug:
 
-			if self.debug:
+			for tag in self.coins[0].ecresolve_tags:
 
-				logging.info('TX({}): {}'.format(eccPacket._protocol_id_ecresolve, ecc_packet.to_json()))
+				logging.info('TX({}): {}'.format(eccPacket._protocol_id_ecresolve, ecc_packet.encode_for(tag, eccPacket.compact_for(tag, self.peers))))
 
-			ecc_packet.send(self.coins[0])
+		ecc_packet.send_fanout(self.coins[0], self.coins[0].ecresolve_tags, self.peers)
 
 	############################################################################
 
@@ -186,11 +317,79 @@ class EchoApp:
 				'name' : self.name,
 				'type' : 'chatname'}
 
-		self.send_ecresolve_packet(eccPacket.METH_nameAdv, data)
+		# One sendpacket per ecresolve tag - sent from the worker pool to keep the loop free
+
+		self.event_loop.run_in_worker(self.advertise_chat_name_complete, self.send_ecresolve_packet, eccPacket.METH_nameAdv, data)
+
+	############################################################################
+
+	def advertise_chat_name_complete(self, result, error):
+
+		if error:
+
+			logging.info('Chat name advertisement failed : {}'.format(str(error)))
+
+	############################################################################
+
+	def dispatch_ecc_packet(self, ecc_packet):
+
+		# Senders over their rate are dropped here, before any route setup or reply RPCs
+
+		if not self.rateLimiter.allow(ecc_packet.get_from(), ecc_packet.get_meth()):
+
+			return
+
+		# Usage tracking is only touched on the loop thread - a #USAGE reply gets the count taken here
+
+		data = ecc_packet.get_data()
+
+		if ecc_packet.get_meth() == eccPacket.METH_chatMsg and isinstance(data.get('text'), str) and data['text'].startswith('#USAGE'):
+
+			usage = self.usageTrack.count()
+
+		else:
+
+			usage = None
+
+		# Packets from one sender are processed in order on one worker, different senders in parallel
+
+		if self.workers:
+
+			self.event_loop.run_ordered(ecc_packet.get_from(), functools.partial(self.process_ecc_packet_complete, ecc_packet), self.process_ecc_packet, ecc_packet, usage)
+
+		else:
+
+			try:
+
+				echoed = self.process_ecc_packet(ecc_packet, usage)
+
+			except Exception as error:
+
+				self.process_ecc_packet_complete(ecc_packet, None, error)
+
+			else:
+
+				self.process_ecc_packet_complete(ecc_packet, echoed, None)
+
+	############################################################################
+
+	def process_ecc_packet_complete(self, ecc_packet, echoed, error):
+
+		# Back on the loop thread - usage tracking is only touched here
+
+		if error:
+
+			logging.info('Packet from {} failed : {}'.format(ecc_packet.get_from(), str(error)))
+
+		elif echoed:
+
+			self.usageTrack.usageByTag(ecc_packet.get_from())
 
 	############################################################################
 
-	def process_ecc_packet(self, ecc_packet):
+	def process_ecc_packet(self, ecc_packet, usage = None):
+
+		# Runs on a packet worker unless --workers 0 - returns True once a chat message has been echoed
 
 		# Ensure we have a route back to whoever is sending an ecchat message
 
@@ -224,7 +423,7 @@ class EchoApp:
 
 			elif data['text'].startswith('#USAGE'):
 
-				reply.append("Unique users (identified by ECC routing tag) = {:d}".format(self.usageTrack.count()))
+				reply.append("Unique users (identified by ECC routing tag) = {:d}".format(usage))
 
 			else:
 
@@ -240,7 +439,7 @@ class EchoApp:
 
 				self.send_ecchat_packet(ecc_packet.get_from(), eccPacket.METH_chatMsg, echData)
 
-			self.usageTrack.usageByTag(ecc_packet.get_from())
+			return True
 
 		elif ecc_packet.get_meth() == eccPacket.METH_addrReq:
 
@@ -293,19 +492,57 @@ class EchoApp:
 				self.subscribers[index].connect(coin.zmqAddress)
 				self.subscribers[index].setsockopt(zmq.SUBSCRIBE, b'')
 
+				self.event_loop.watch_queue(self.subscribers[index], self.zmqHandler, zmq.POLLIN, index)
+
 	############################################################################
 
 	def zmqHandler(self, index):
 
-		[address, contents] = self.subscribers[index].recv_multipart()
-		
-		if address.decode() == 'packet':
+		# Drain whatever is queued, up to the loop budget
+		# A burst of notifications for one protocol id needs only one get_buffer call
+
+		messages = self.event_loop.drain_queue(self.subscribers[index])
+
+		protocols = []
+
+		for [address, contents] in messages:
+
+			if address.decode() == 'packet' and contents.decode()[1:] not in protocols:
+
+				protocols.append(contents.decode()[1:])
+
+		for protocolID in protocols:
+
+			self.process_buffer(protocolID)
 
-			protocolID = contents.decode()[1:]
+	############################################################################
+
+	def process_buffer(self, protocolID):
+
+		# The buffer is fetched on the worker pool - one fetch in flight per protocol id,
+		# notifications arriving meanwhile are coalesced into a single refetch
+
+		if protocolID in self.buffer_fetching:
+
+			self.buffer_fetching[protocolID] = True
+
+			return
+
+		self.buffer_fetching[protocolID] = False
+
+		self.event_loop.run_in_worker(functools.partial(self.process_buffer_complete, protocolID), self.coins[0].get_buffer, int(protocolID))
 
-			eccbuffer = self.coins[0].get_buffer(int(protocolID))
+	############################################################################
+
+	def process_buffer_complete(self, protocolID, eccbuffer, error):
 
-			if eccbuffer:
+		try:
+
+			if error:
+
+				logging.info('RX({}): Buffer fetch failed : {}'.format(protocolID, str(error)))
+
+			elif eccbuffer:
 
 				for packet in eccbuffer.values():
 
@@ -315,9 +552,25 @@ class EchoApp:
 
 						logging.info('RX({}): {}'.format(protocolID, message))
 
-					ecc_packet = eccPacket.from_json(message)
+					try:
+
+						ecc_packet = eccPacket.from_json(message)
+
+					except eccPacketException as error:
+
+						logging.info('RX({}): Packet rejected : {}'.format(protocolID, str(error)))
 
-					self.process_ecc_packet(ecc_packet)
+						continue
+
+					self.peers.record(ecc_packet)
+
+					self.dispatch_ecc_packet(ecc_packet)
+
+		finally:
+
+			if self.buffer_fetching.pop(protocolID, False):
+
+				self.process_buffer(protocolID)
 
 	############################################################################
 
@@ -333,7 +586,31 @@ class EchoApp:
 
 	def reset_buffer_timeouts(self):
 
-		self.coins[0].reset_buffer_timeouts()
+		self.event_loop.run_in_worker(self.reset_buffer_timeouts_complete, self.coins[0].reset_buffer_timeouts)
+
+	############################################################################
+
+	def reset_buffer_timeouts_complete(self, result, error):
+
+		if error:
+
+			logging.info('Buffer timeout reset failed : {}'.format(str(error)))
+
+	############################################################################
+
+	def logRpcStats(self):
+
+		for line in self.coins[0].get_rpc_stats_lines():
+
+			logging.info('RPC stats : {}'.format(line))
+
+		for line in self.event_loop.monitor.snapshot_lines():
+
+			logging.info('Loop stats : {}'.format(line))
+
+		for line in self.rateLimiter.snapshot_lines():
+
+			logging.info('Rate stats : {}'.format(line))
 
 	############################################################################
 
@@ -371,13 +648,13 @@ class EchoApp:
 
 					return False
 
-				self.buffer_timer   = RepeatTimer(10, self.reset_buffer_timeouts)
+				self.buffer_timer   = self.event_loop.set_interval(10, self.reset_buffer_timeouts)
 
-				self.buffer_timer.start()
+				self.chatname_timer = self.event_loop.set_interval(60, self.advertise_chat_name)
 
-				self.chatname_timer = RepeatTimer(60, self.advertise_chat_name)
+				if self.stats:
 
-				self.chatname_timer.start()
+					self.stats_timer = self.event_loop.set_interval(self.stats, self.logRpcStats)
 
 			return True
 
@@ -389,11 +666,17 @@ class EchoApp:
 
 		if self.buffer_timer:
 
-			self.buffer_timer.cancel()
+			self.event_loop.cancel_interval(self.buffer_timer)
 
 		if self.chatname_timer:
 
-			self.chatname_timer.cancel()
+			self.event_loop.cancel_interval(self.chatname_timer)
+
+		if self.stats_timer:
+
+			self.event_loop.cancel_interval(self.stats_timer)
+
+			self.logRpcStats()
 
 		for coin in self.coins:
 
@@ -401,43 +684,37 @@ class EchoApp:
 
 	############################################################################
 
-	def run(self):
-
-		self.usageTrack.start()
+	def stop(self):
 
-		if self.cryptoInitialise():
+		self.event_loop.stop()
 
-			self.zmqInitialise()
+	############################################################################
 
-			while self.running:
+	def run(self):
 
-				try:
+		self.usageTrack.start(self.event_loop)
 
-					self.zmqHandler(0)
+		if self.cryptoInitialise():
 
-				except ServiceExit:
+			self.zmqInitialise()
 
-					self.running = False
+			self.event_loop.run()
 
 			self.zmqShutdown()
 
+		self.event_loop.shutdown_workers()
+
 		self.cryptoShutdown()
 
 		self.usageTrack.stop()
 
 ################################################################################
 
-class ServiceExit(Exception):
-
-	pass
-
-################################################################################
-
-def terminate(signalNumber, frame):
+def terminate(app, signalNumber, frame):
 
 	logging.info('%s received - terminating' % signal.Signals(signalNumber).name)
 
-	raise ServiceExit
+	app.stop()
 
 ################################################################################
 ### Main program ###############################################################
@@ -459,24 +736,40 @@ def main():
 
 	logging.info('STARTUP')
 
-	signal.signal(signal.SIGINT,  terminate)  # keyboard interrupt ^C
-	signal.signal(signal.SIGTERM, terminate)  # kill [default -15]
-
 	argparser = argparse.ArgumentParser(description='Echo service for ecchat')
 
 	argparser.add_argument('-p', '--protocol', action='store'     , help='Protocol ID'      , type=int, default=1       , required=False)
 	argparser.add_argument('-n', '--name'    , action='store'     , help='nickname'         , type=str, default='ececho', required=False)
 	argparser.add_argument('-x', '--prefix'  , action='store'     , help='reply prefix'     , type=str, default='> '    , required=False)
 	argparser.add_argument('-d', '--debug'   , action='store_true', help='debug message log',                             required=False)
+	argparser.add_argument('-s', '--stats'   , action='store'     , help='RPC stats log interval seconds (0 = off)', type=int, default=300, required=False)
+	argparser.add_argument('-t', '--slow'    , action='store'     , help='slow callback log threshold seconds'    , type=float, default=0.1, required=False)
+	argparser.add_argument('-w', '--workers' , action='store'     , help='packet workers (0 = process on the main loop)', type=int, default=4, required=False)
+	argparser.add_argument('-u', '--exact-usage', action='store_true', help='count unique users exactly as well as by estimate', required=False)
+	argparser.add_argument('-r', '--rate'    , action='append'    , help='per sender limit method=rate[:burst] (repeatable)', type=rate_spec, default=[], required=False)
 
 	command_line_args = argparser.parse_args()
 
+	for meth, rate, burst in command_line_args.rate:
+
+		if meth not in eccPacket.METH_SET:
+
+			argparser.error('unknown method in rate : {}'.format(meth))
+
 	logging.info('Arguments %s', vars(command_line_args))
 
 	app = EchoApp(command_line_args.protocol,
 	              command_line_args.name,
 	              command_line_args.prefix,
-	              command_line_args.debug)
+	              command_line_args.debug,
+	              command_line_args.stats,
+	              command_line_args.slow,
+	              command_line_args.workers,
+	              command_line_args.exact_usage,
+	              command_line_args.rate)
+
+	signal.signal(signal.SIGINT,  functools.partial(terminate, app))  # keyboard interrupt ^C
+	signal.signal(signal.SIGTERM, functools.partial(terminate, app))  # kill [default -15]
 
 	app.run()
 
@@ -1,16 +1,21 @@
 #!/usr/bin/env python3
 # coding: UTF-8
 
-import threading
+import functools
 import datetime
 import argparse
 import pathlib
 import logging
 import hashlib
 import signal
+import heapq
 import codecs
+import shutil
 import pickle
+import json
+import time
 import zmq
+import os
 import sys
 
 from uuid import uuid4
@@ -21,20 +26,24 @@ from configure import loadConfigurationECC
 
 # eccPacket & cryptoNode  classes
 
-from eccpacket    import eccPacket
+from eccpacket    import eccPacket, eccPacketException, eccPeers
 from cryptonode   import cryptoNode, eccoinNode, cryptoNodeException
 
-################################################################################
-## RepeatTimer class ###########################################################
-################################################################################
+# Constant memory unique user counting
+
+from hyperloglog  import HyperLogLog
 
-class RepeatTimer(threading.Timer):
+# Exact hash set on disk - append only journal compacted into a sorted, memory mapped index
 
-    def run(self):
+from hashstore    import HashStore
 
-        while not self.finished.wait(self.interval):
+# Per sender token bucket admission control
 
-            self.function(*self.args, **self.kwargs)
+from ratelimit    import RateLimiter, rate_spec
+
+# Single threaded event loop - timers, zmq and a worker pool for blocking work
+
+from zmqeventloop import zmqEventLoop
 
 ################################################################################
 ## UsageTrack class ############################################################
@@ -44,7 +53,7 @@ class UsageTrack:
 
 	############################################################################
 
-	def __init__(self, name):
+	def __init__(self, name, exact = False):
 
 		self.usageFilePath = 'net'
 		self.usageFileName = name + '-usage.dat'
@@ -52,34 +61,57 @@ class UsageTrack:
 		pathlib.Path(self.usageFilePath).mkdir(parents=True, exist_ok=True)
 
 		self.filePath  = pathlib.Path(self.usageFilePath) / self.usageFileName
+		self.hllPath   = self.filePath.with_suffix('.hll')
+
+		# Unique users are estimated in constant memory - the exact hash set is optional
 
-		self.tagHashes = self.loadListFile(self.filePath)
+		self.exact     = exact
 
 		self.changed   = False
 
+		self.tagHashes = self.openStore() if exact else None
+
+		self.counter   = self.loadCounter(self.hllPath)
+
+		self.saving    = False
+
 	############################################################################
 
-	def start(self):
+	def start(self, loop):
 
-		self.timer = RepeatTimer(60, self.saveIfNecessary)
+		self.loop = loop
 
-		self.timer.start()
+		self.timer = loop.set_interval(60, self.saveIfNecessary)
 
 	############################################################################
 
 	def stop(self):
 
-		self.timer.cancel()
+		# Loop has stopped - final save is made synchronously
+
+		self.loop.cancel_interval(self.timer)
+
+		if self.changed:
+
+			work = self.tagHashes.take_batch() if self.exact else None
+
+			self.saveComplete(self.saveFiles(work, self.counter.to_bytes()), None, work)
+
+		if self.exact:
+
+			self.tagHashes.close()
 
 	############################################################################
 
 	def usageByTag(self, tag):
 
-		tagHash = hashlib.sha256(tag.encode()).hexdigest()
+		tagHash = hashlib.sha256(tag.encode())
 
-		if tagHash not in self.tagHashes:
+		if self.counter.add_hash(tagHash.digest()):
 
-			self.tagHashes.append(tagHash)
+			self.changed = True
+
+		if self.exact and self.tagHashes.add(tagHash.digest()):
 
 			self.changed = True
 
@@ -87,49 +119,136 @@ class UsageTrack:
 
 	def count(self):
 
-		return len(self.tagHashes)
+		if self.exact:
+
+			return len(self.tagHashes)
+
+		return int(round(self.counter.count()))
 
 	############################################################################
 
 	def saveIfNecessary(self):
 
-		if self.changed:
+		# Only hashes added since the last save are appended, on the worker pool - one save in flight keeps writes ordered
+
+		if self.changed and not self.saving:
 
-			self.saveListFile(self.tagHashes, self.filePath)
+			self.saving  = True
 
 			self.changed = False
 
+			work = self.tagHashes.take_batch() if self.exact else None
+
+			self.loop.run_in_worker(functools.partial(self.saveComplete, work = work), self.saveFiles, work, self.counter.to_bytes())
+
 	############################################################################
 
-	def loadListFile(self, filePath = ''):
+	def saveComplete(self, result, error, work = None):
 
-		nullList = []
+		self.saving = False
 
-		if not pathlib.Path(filePath).is_file():
+		if error:
 
-			with open(filePath, 'wb') as f:
+			logging.info('UsageTrack : Save failed : {}'.format(str(error)))
 
-				pickle.dump(nullList, f)
+			if work:
 
-				f.close()
+				self.tagHashes.write_failed(work)
 
-				return nullList
+			self.changed = True
 
-		else:
+		elif work:
+
+			self.tagHashes.compacted(result)
+
+	############################################################################
+
+	def saveFiles(self, work, counter):
+
+		# Registers are written to a temporary file and renamed so a crash never leaves a torn file
 
-			with open(filePath, 'rb') as f:
+		temp = self.hllPath.with_suffix('.tmp')
 
-				return pickle.load(f)
+		with open(temp, 'wb') as f:
+
+			f.write(counter)
+
+		os.replace(temp, self.hllPath)
+
+		if work:
+
+			return self.tagHashes.write_batch(work)
+
+		return None
 
 	############################################################################
 
-	def saveListFile(self, list = [], filePath = ''):
+	def loadCounter(self, filePath):
+
+		if pathlib.Path(filePath).is_file():
+
+			try:
+
+				with open(filePath, 'rb') as f:
+
+					return HyperLogLog.from_bytes(f.read())
 
-		with open(filePath, 'wb') as f:
+			except (OSError, IndexError, ValueError) as error:
 
-			pickle.dump(list, f)
+				logging.info('UsageTrack : Counter unreadable, reseeding : {}'.format(str(error)))
 
-			f.close()
+		counter = HyperLogLog()
+
+		# First run with the estimator, or an unreadable counter - seed it from the exact hashes held
+
+		if self.tagHashes is not None:
+
+			for tagHash in self.tagHashes:
+
+				counter.add_hash(tagHash)
+
+			self.changed = True
+
+		elif pathlib.Path(self.filePath).is_file():
+
+			for tagHash in self.loadListFile(self.filePath):
+
+				counter.add_hash(bytes.fromhex(tagHash))
+
+			self.changed = True
+
+		return counter
+
+	############################################################################
+
+	def openStore(self):
+
+		# Exact hashes live in an append only journal compacted into a sorted index
+		# First run with the store - migrate the old pickled hash list into the index
+
+		store = HashStore(self.filePath.with_suffix(''))
+
+		if not len(store) and pathlib.Path(self.filePath).is_file():
+
+			for tagHash in self.loadListFile(self.filePath):
+
+				store.add(bytes.fromhex(tagHash))
+
+			store.compacted(store.write_batch(store.take_batch(True)))
+
+		return store
+
+	############################################################################
+
+	def loadListFile(self, filePath = ''):
+
+		if not pathlib.Path(filePath).is_file():
+
+			return []
+
+		with open(filePath, 'rb') as f:
+
+			return pickle.load(f)
 
 ################################################################################
 ## NamesCache class ############################################################
@@ -137,39 +256,319 @@ class UsageTrack:
 
 class NamesCache:
 
+	compactFraction = 0.5	# Rebuild the expiry heap once this fraction of it is superseded leases ...
+	compactMinimum  = 1024	# ... and there are at least this many
+
+	snapshotInterval = 300	# Seconds between snapshots - the journal holds registrations made since the last one
+
 	############################################################################
 
-	def __init__(self, timeout):
+	def __init__(self, timeout, name):
 
 		self.timeout = timeout
 
 		self.cache = {}
 
+		self.expiry = []		# Min-heap of (until, name) - leases superseded by an extension are skipped when popped
+
+		self.stale  = 0			# Superseded leases still in the heap
+
+		self.namesFilePath = 'net'
+
+		pathlib.Path(self.namesFilePath).mkdir(parents=True, exist_ok=True)
+
+		self.snapshotPath = pathlib.Path(self.namesFilePath) / (name + '-names.dat')
+		self.journalPath  = pathlib.Path(self.namesFilePath) / (name + '-names.jnl')
+		self.rotatedPath  = pathlib.Path(self.namesFilePath) / (name + '-names.jnl.1')	# Journal covered by a snapshot being written
+
+		self.journal = None
+
+		self.snapshotting = False
+
 	############################################################################
 
-	def start(self):
+	def start(self, loop):
+
+		self.loop  = loop
+
+		self.load()
 
-		self.timer = RepeatTimer(10, self.timeoutNames)
+		self.openJournal()
 
-		self.timer.start()
+		self.timer = loop.set_interval(10, self.timeoutNames)
+
+		self.snapshot_timer = loop.set_interval(self.snapshotInterval, self.snapshot)
 
 	############################################################################
 
 	def stop(self):
 
-		self.timer.cancel()
+		# Loop has stopped - the final snapshot is written synchronously
+
+		self.loop.cancel_interval(self.timer)
+
+		self.loop.cancel_interval(self.snapshot_timer)
+
+		if self.journal:
+
+			self.journal.close()
+
+			self.journal = None
+
+		self.saveSnapshot(self.snapshotEntries(), (self.rotatedPath, self.journalPath))
+
+	############################################################################
+
+	def load(self):
+
+		# Warm restart - snapshot, then any journal left by an interrupted snapshot, then the live journal
+		# Leases are stored as unix times so entries come back with their remaining lease
+		# A journal may already be covered by the snapshot, so the record with the later lease wins -
+		# an owner only ever extends its lease and a new owner registers after the old lease ran out
+
+		entries = {}
+
+		if self.snapshotPath.is_file():
+
+			try:
+
+				with open(self.snapshotPath, 'rb') as f:
+
+					for entry in pickle.load(f):
+
+						entries[entry[0]] = entry
+
+			except (OSError, EOFError, pickle.UnpicklingError) as error:
+
+				logging.info('NamesCache : Snapshot unreadable : {}'.format(str(error)))
+
+		for path in (self.rotatedPath, self.journalPath):
+
+			if path.is_file():
+
+				with open(path, 'rb') as f:
+
+					data = f.read()
+
+				whole = data.rfind(b'\n') + 1
+
+				if whole != len(data):
+
+					with open(path, 'r+b') as f:
+
+						f.truncate(whole) # Torn final record from a crash mid write - later appends start on a fresh line
+
+				for line in data[:whole].decode(errors = 'replace').splitlines():
+
+					try:
+
+						entry = json.loads(line)
+
+					except ValueError:
+
+						continue # Corrupt record
+
+					if not self.validEntry(entry):
+
+						logging.info('NamesCache : Journal record skipped : {}'.format(line.strip()))
+
+						continue
+
+					if entry[0] not in entries or entry[3] > entries[entry[0]][3]:
+
+						entries[entry[0]] = entry
+
+		now = time.time()
+
+		for name, name_type, name_tag, until in entries.values():
+
+			if until > now:
+
+				self.cache[name] = {'type' : name_type, 'tag' : name_tag, 'until' : datetime.datetime.fromtimestamp(until)}
+
+				self.setExpiry(name, self.cache[name]['until'])
+
+		logging.info('NamesCache : Names restored : {}'.format(len(self.cache)))
+
+	############################################################################
+
+	@staticmethod
+
+	def validEntry(entry):
+
+		# [name, type, tag, until] as written by journalAdd()
+
+		return (isinstance(entry, list) and len(entry) == 4 and all(isinstance(field, str) for field in entry[:3])
+				and isinstance(entry[3], (int, float)) and not isinstance(entry[3], bool))
+
+	############################################################################
+
+	def journalAdd(self, name):
+
+		# Appended on the loop thread - flushed with each expiry tick and made durable by the next snapshot
+
+		if self.journal:
+
+			entry = self.cache[name]
+
+			try:
+
+				self.journal.write(json.dumps([name, entry['type'], entry['tag'], entry['until'].timestamp()]) + '\n')
+
+			except OSError as error:
+
+				logging.info('NamesCache : Journal write failed : {}'.format(str(error))) # Still covered by the next snapshot
+
+	############################################################################
+
+	def snapshotEntries(self):
+
+		return [(name, entry['type'], entry['tag'], entry['until'].timestamp()) for name, entry in self.cache.items()]
+
+	############################################################################
+
+	def snapshot(self):
+
+		# Rotate the journal on the loop thread so nothing registered after the copy is lost, then write on a worker
+
+		if self.snapshotting or not self.rotateJournal():
+
+			return
+
+		self.snapshotting = True
+
+		self.loop.run_in_worker(self.snapshotComplete, self.saveSnapshot, self.snapshotEntries(), (self.rotatedPath,))
+
+	############################################################################
+
+	def rotateJournal(self):
+
+		# Loop thread - a journal left by a failed snapshot is appended to rather than replaced
+		# The live journal is reopened whatever happens so a failure here cannot stop journalAdd
+
+		try:
+
+			if self.journal:
+
+				self.journal.close()
+
+			if self.journalPath.is_file():
+
+				if self.rotatedPath.is_file():
+
+					with open(self.journalPath, 'r') as live, open(self.rotatedPath, 'a') as rotated:
+
+						shutil.copyfileobj(live, rotated)
+
+					self.journalPath.unlink()
+
+				else:
+
+					os.replace(self.journalPath, self.rotatedPath)
+
+			rotated = True
+
+		except OSError as error:
+
+			logging.info('NamesCache : Journal rotation failed : {}'.format(str(error)))
+
+			rotated = False
+
+		self.openJournal()
+
+		return rotated
+
+	############################################################################
+
+	def openJournal(self):
+
+		try:
+
+			self.journal = open(self.journalPath, 'a')
+
+		except OSError as error:
+
+			logging.info('NamesCache : Journal unavailable until the next snapshot : {}'.format(str(error)))
+
+			self.journal = None
+
+	############################################################################
+
+	def snapshotComplete(self, result, error):
+
+		self.snapshotting = False
+
+		if error:
+
+			logging.info('NamesCache : Snapshot failed : {}'.format(str(error)))
+
+	############################################################################
+
+	def saveSnapshot(self, entries, journals):
+
+		temp = self.snapshotPath.with_suffix('.tmp')
+
+		with open(temp, 'wb') as f:
+
+			pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+
+			f.flush()
+
+			os.fsync(f.fileno())
+
+		os.replace(temp, self.snapshotPath)
+
+		for journal in journals:
+
+			if journal.is_file():
+
+				journal.unlink()
 
 	############################################################################
 
 	def timeoutNames(self):
 
+		# Only leases that have run out are visited
+
+		if self.journal:
+
+			try:
+
+				self.journal.flush()
+
+			except OSError as error:
+
+				logging.info('NamesCache : Journal flush failed : {}'.format(str(error)))
+
 		now = datetime.datetime.now()
 
-		for key in [k for k, v in self.cache.items() if v['until'] < now]:
+		while self.expiry and self.expiry[0][0] < now:
+
+			until, key = heapq.heappop(self.expiry)
+
+			if key in self.cache and self.cache[key]['until'] == until:
 
-			logging.info('NamesCache : Name timedout : {}/{}'.format(key, self.cache[key]['type']))
+				logging.info('NamesCache : Name timedout : {}/{}'.format(key, self.cache[key]['type']))
 
-			del self.cache[key]
+				del self.cache[key]
+
+			else:
+
+				self.stale -= 1
+
+	############################################################################
+
+	def setExpiry(self, name, until):
+
+		heapq.heappush(self.expiry, (until, name))
+
+		if self.stale >= self.compactMinimum and self.stale > len(self.expiry) * self.compactFraction:
+
+			self.expiry = [(v['until'], k) for k, v in self.cache.items()]
+
+			heapq.heapify(self.expiry)
+
+			self.stale = 0
 
 	############################################################################
 
@@ -183,6 +582,12 @@ class NamesCache:
 
 				self.cache[name]['until'] = until
 
+				self.stale += 1
+
+				self.setExpiry(name, until)
+
+				self.journalAdd(name)
+
 				logging.info('NamesCache : Name extended : {}/{}'.format(name, name_type))
 
 				return True
@@ -197,6 +602,10 @@ class NamesCache:
 
 			self.cache[name] = {'type' : name_type, 'tag' : name_tag, 'until' : until}
 
+			self.setExpiry(name, until)
+
+			self.journalAdd(name)
+
 			logging.info('NamesCache : Name register : {}/{}'.format(name, name_type))
 
 			return True
@@ -217,23 +626,58 @@ class NamesCache:
 
 		return []
 
+	############################################################################
+
+	def resolve_batch(self, names, name_type):
+
+		# One pass over the cache for a list of names - tags are returned in the same order
+
+		tags = []
+
+		for name in names:
+
+			entry = self.cache.get(name)
+
+			tags.append([entry['tag']] if entry and entry['type'] == name_type else [])
+
+		logging.info('NamesCache : Batch resolved : {:d}/{:d} {}'.format(sum(1 for tag in tags if tag), len(names), name_type))
+
+		return tags
+
 ################################################################################
 ## ServiceApp class ############################################################
 ################################################################################
 
 class ServiceApp:
 
-	def __init__(self, name, debug=False):
+	# Default per sender limits as (packets per second, burst) - clients advertise once a minute
+
+	defaultRates = {eccPacket.METH_nameAdv      : (0.2,  5.0),
+					eccPacket.METH_nameReq      : (2.0, 10.0),
+					eccPacket.METH_nameReqBatch : (0.5,  5.0)}
+
+	otherRate    = (5.0, 20.0)
+
+	batchLimit   = 64		# Most names resolved by one nameReqBatch - keeps the response within one packet
+
+	def __init__(self, name, debug=False, stats=300, slow=0.1, exact_usage=False, rates=()):
 
 		self.name			= name
 		self.debug			= debug
+		self.stats			= stats
+		self.event_loop		= zmqEventLoop(slow, name = name)
 		self.subscribers	= []
 		self.coins			= []
-		self.running		= True
-		self.timer          = 0
+		self.peers			= eccPeers()
+		self.timer          = None
+		self.stats_timer    = None
+
+		self.buffer_fetching = {}	# protocolID : refetch flag
+
+		self.usageTrack		= UsageTrack(name, exact_usage)
+		self.namesCache     = NamesCache(90, name)
 
-		self.usageTrack		= UsageTrack(name)
-		self.namesCache     = NamesCache(90)
+		self.rateLimiter	= RateLimiter(name, dict(self.defaultRates, **{meth : (rate, burst) for meth, rate, burst in rates}), self.otherRate)
 
 	############################################################################
 
@@ -243,27 +687,49 @@ class ServiceApp:
 
 		if self.debug:
 
-			logging.info('TX({}): {}'.format(rid, ecc_packet.to_json()))
+			logging.info('TX({}): {}'.format(rid, ecc_packet.encode(eccPacket.compact_for(dest, self.peers))))
 
-		ecc_packet.send_response(self.coins[0])
+		ecc_packet.send_response(self.coins[0], self.peers)
 
 	############################################################################
 
-	def process_ecc_packet(self, ecc_packet):
+	def send_response_async(self, request, meth, data):
 
-		# Ensure we have a route back to whoever sent the ecresolve message for messages needing a response
+		self.event_loop.run_in_worker(functools.partial(self.send_response_complete, request), self.send_response, request.get_from(), request.get_rid(), meth, data)
 
-		if ecc_packet.get_meth() in (eccPacket.METH_nameReq):
+	############################################################################
 
-			try:
+	def send_response(self, dest, rid, meth, data):
 
-				self.coins[0].setup_route(ecc_packet.get_from())
+		# Worker thread - ensure we have a route back to whoever sent the request, then respond
 
-			except cryptoNodeException as error:
+		self.coins[0].setup_route(dest)
 
-				logging.info(str(error))
+		self.send_response_packet(dest, rid, meth, data)
 
-				return
+	############################################################################
+
+	def send_response_complete(self, request, result, error):
+
+		if isinstance(error, cryptoNodeException):
+
+			logging.info(str(error))
+
+		elif error:
+
+			logging.info('Response to {} failed : {}'.format(request.get_from(), str(error)))
+
+	############################################################################
+
+	def process_ecc_packet(self, ecc_packet):
+
+		# Senders over their rate are dropped here, before any route setup or response RPCs
+
+		if not self.rateLimiter.allow(ecc_packet.get_from(), ecc_packet.get_meth()):
+
+			return
+
+		# The cache is used here on the loop thread - route setup and responses go to the worker pool
 
 		if ecc_packet.get_meth() == eccPacket.METH_nameAdv:
 
@@ -284,7 +750,26 @@ class ServiceApp:
 					 'type' : data['type'],
 					 'tags' : tags}
 
-			self.send_response_packet(ecc_packet.get_from(), ecc_packet.get_rid(), eccPacket.METH_nameRes, rData)
+			self.send_response_async(ecc_packet, eccPacket.METH_nameRes, rData)
+
+		elif ecc_packet.get_meth() == eccPacket.METH_nameReqBatch:
+
+			data = ecc_packet.get_data()
+
+			if not isinstance(data['names'], list):
+
+				logging.info('nameReqBatch from {} rejected : names is not a list'.format(ecc_packet.get_from()))
+
+				return
+
+			names = [name for name in data['names'] if isinstance(name, str)][:self.batchLimit]
+
+			rData = {'uuid'  : data['uuid'],
+					 'type'  : data['type'],
+					 'names' : names,
+					 'tags'  : self.namesCache.resolve_batch(names, data['type'])}
+
+			self.send_response_async(ecc_packet, eccPacket.METH_nameResBatch, rData)
 
 		else:
 
@@ -305,19 +790,57 @@ class ServiceApp:
 				self.subscribers[index].connect(coin.zmqAddress)
 				self.subscribers[index].setsockopt(zmq.SUBSCRIBE, b'')
 
+				self.event_loop.watch_queue(self.subscribers[index], self.zmqHandler, zmq.POLLIN, index)
+
 	############################################################################
 
 	def zmqHandler(self, index):
 
-		[address, contents] = self.subscribers[index].recv_multipart()
-		
-		if address.decode() == 'packet':
+		# Drain whatever is queued, up to the loop budget
+		# A burst of notifications for one protocol id needs only one get_buffer call
+
+		messages = self.event_loop.drain_queue(self.subscribers[index])
+
+		protocols = []
 
-			protocolID = contents.decode()[1:]
+		for [address, contents] in messages:
 
-			eccbuffer = self.coins[0].get_buffer(int(protocolID))
+			if address.decode() == 'packet' and contents.decode()[1:] not in protocols:
 
-			if eccbuffer:
+				protocols.append(contents.decode()[1:])
+
+		for protocolID in protocols:
+
+			self.process_buffer(protocolID)
+
+	############################################################################
+
+	def process_buffer(self, protocolID):
+
+		# The buffer is fetched on the worker pool - one fetch in flight per protocol id,
+		# notifications arriving meanwhile are coalesced into a single refetch
+
+		if protocolID in self.buffer_fetching:
+
+			self.buffer_fetching[protocolID] = True
+
+			return
+
+		self.buffer_fetching[protocolID] = False
+
+		self.event_loop.run_in_worker(functools.partial(self.process_buffer_complete, protocolID), self.coins[0].get_buffer, int(protocolID))
+
+	############################################################################
+
+	def process_buffer_complete(self, protocolID, eccbuffer, error):
+
+		try:
+
+			if error:
+
+				logging.info('RX({}): Buffer fetch failed : {}'.format(protocolID, str(error)))
+
+			elif eccbuffer:
 
 				for packet in eccbuffer.values():
 
@@ -327,10 +850,26 @@ class ServiceApp:
 
 						logging.info('RX({}): {}'.format(protocolID, message))
 
-					ecc_packet = eccPacket.from_json(message)
+					try:
+
+						ecc_packet = eccPacket.from_json(message)
+
+					except eccPacketException as error:
+
+						logging.info('RX({}): Packet rejected : {}'.format(protocolID, str(error)))
+
+						continue
+
+					self.peers.record(ecc_packet)
 
 					self.process_ecc_packet(ecc_packet)
 
+		finally:
+
+			if self.buffer_fetching.pop(protocolID, False):
+
+				self.process_buffer(protocolID)
+
 	############################################################################
 
 	def zmqShutdown(self):
@@ -345,7 +884,31 @@ class ServiceApp:
 
 	def reset_buffer_timeouts(self):
 
-		self.coins[0].reset_buffer_timeouts()
+		self.event_loop.run_in_worker(self.reset_buffer_timeouts_complete, self.coins[0].reset_buffer_timeouts)
+
+	############################################################################
+
+	def reset_buffer_timeouts_complete(self, result, error):
+
+		if error:
+
+			logging.info('Buffer timeout reset failed : {}'.format(str(error)))
+
+	############################################################################
+
+	def logRpcStats(self):
+
+		for line in self.coins[0].get_rpc_stats_lines():
+
+			logging.info('RPC stats : {}'.format(line))
+
+		for line in self.event_loop.monitor.snapshot_lines():
+
+			logging.info('Loop stats : {}'.format(line))
+
+		for line in self.rateLimiter.snapshot_lines():
+
+			logging.info('Rate stats : {}'.format(line))
 
 	############################################################################
 
@@ -383,9 +946,11 @@ class ServiceApp:
 
 					return False
 
-				self.timer = RepeatTimer(10, self.reset_buffer_timeouts)
+				self.timer = self.event_loop.set_interval(10, self.reset_buffer_timeouts)
 
-				self.timer.start()
+				if self.stats:
+
+					self.stats_timer = self.event_loop.set_interval(self.stats, self.logRpcStats)
 
 			return True
 
@@ -397,7 +962,13 @@ class ServiceApp:
 
 		if self.timer:
 
-			self.timer.cancel()
+			self.event_loop.cancel_interval(self.timer)
+
+		if self.stats_timer:
+
+			self.event_loop.cancel_interval(self.stats_timer)
+
+			self.logRpcStats()
 
 		for coin in self.coins:
 
@@ -405,27 +976,27 @@ class ServiceApp:
 
 	############################################################################
 
-	def run(self):
-
-		self.usageTrack.start()
-		self.namesCache.start()
+	def stop(self):
 
-		if self.cryptoInitialise():
+		self.event_loop.stop()
 
-			self.zmqInitialise()
+	############################################################################
 
-			while self.running:
+	def run(self):
 
-				try:
+		self.usageTrack.start(self.event_loop)
+		self.namesCache.start(self.event_loop)
 
-					self.zmqHandler(0)
+		if self.cryptoInitialise():
 
-				except ServiceExit:
+			self.zmqInitialise()
 
-					self.running = False
+			self.event_loop.run()
 
 			self.zmqShutdown()
 
+		self.event_loop.shutdown_workers()
+
 		self.cryptoShutdown()
 
 		self.usageTrack.stop()
@@ -433,17 +1004,11 @@ class ServiceApp:
 
 ################################################################################
 
-class ServiceExit(Exception):
-
-	pass
-
-################################################################################
-
-def terminate(signalNumber, frame):
+def terminate(app, signalNumber, frame):
 
 	logging.info('%s received - terminating' % signal.Signals(signalNumber).name)
 
-	raise ServiceExit
+	app.stop()
 
 ################################################################################
 ### Main program ###############################################################
@@ -455,16 +1020,23 @@ def main():
 
 		raise 'Use Python 3'
 
-	signal.signal(signal.SIGINT,  terminate)  # keyboard interrupt ^C
-	signal.signal(signal.SIGTERM, terminate)  # kill [default -15]
-
 	argparser = argparse.ArgumentParser(description='Echo service for ecchat')
 
 	argparser.add_argument('-n', '--name'    , action='store'     , help='service name'     , type=str, default='ecresolve', required=False)
 	argparser.add_argument('-d', '--debug'   , action='store_true', help='debug message log',                                required=False)
+	argparser.add_argument('-s', '--stats'   , action='store'     , help='RPC stats log interval seconds (0 = off)', type=int, default=300, required=False)
+	argparser.add_argument('-t', '--slow'    , action='store'     , help='slow callback log threshold seconds'    , type=float, default=0.1, required=False)
+	argparser.add_argument('-u', '--exact-usage', action='store_true', help='count unique users exactly as well as by estimate', required=False)
+	argparser.add_argument('-r', '--rate'    , action='append'    , help='per sender limit method=rate[:burst] (repeatable)', type=rate_spec, default=[], required=False)
 
 	command_line_args = argparser.parse_args()
 
+	for meth, rate, burst in command_line_args.rate:
+
+		if meth not in eccPacket.METH_SET:
+
+			argparser.error('unknown method in rate : {}'.format(meth))
+
 	pathlib.Path('log').mkdir(parents=True, exist_ok=True)
 
 	logging.basicConfig(filename = 'log/{}-{:%Y-%m-%d}.log'.format(command_line_args.name, datetime.datetime.now()),
@@ -478,7 +1050,14 @@ def main():
 	logging.info('Arguments %s', vars(command_line_args))
 
 	app = ServiceApp(command_line_args.name,
-	                 command_line_args.debug)
+	                 command_line_args.debug,
+	                 command_line_args.stats,
+	                 command_line_args.slow,
+	                 command_line_args.exact_usage,
+	                 command_line_args.rate)
+
+	signal.signal(signal.SIGINT,  functools.partial(terminate, app))  # keyboard interrupt ^C
+	signal.signal(signal.SIGTERM, functools.partial(terminate, app))  # kill [default -15]
 
 	app.run()
 
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+import pathlib
+import mmap
+import os
+
+################################################################################
+
+class HashStore():
+
+	compactFraction = 0.1			# Fold the journal into the index once it holds this fraction of the index ...
+	compactMinimum  = 4096			# ... and at least this many entries
+
+	# Set of fixed width digests kept on disk as a sorted, memory mapped index plus an append only journal
+	# Membership is a binary search of the index or a lookup in the entries journalled since the last compaction
+	# Loading reads only the journal, saving appends only new entries
+
+	# Threading - add(), take_batch() and compacted() run on the owner's thread
+	# write_batch() may run on a worker, one call in flight at a time
+
+	#############################################################################
+
+	def __init__(self, basePath, width = 32):
+
+		self.width       = width
+		self.indexPath   = pathlib.Path(str(basePath) + '.idx')
+		self.journalPath = pathlib.Path(str(basePath) + '.jnl')
+
+		self.index       = None		# mmap of the sorted index, None while it is empty
+		self.indexCount  = 0
+		self.pending     = set()	# Entries in the journal or the batch, not yet in the index
+		self.batch       = []		# Entries added since the last take_batch()
+
+		self.openIndex()
+
+		self.loadJournal()
+
+	#############################################################################
+
+	def openIndex(self):
+
+		if self.index:
+
+			self.index.close()
+
+		self.index      = None
+		self.indexCount = 0
+
+		if self.indexPath.is_file() and self.indexPath.stat().st_size >= self.width:
+
+			with open(self.indexPath, 'rb') as f:
+
+				self.index = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+			self.indexCount = len(self.index) // self.width
+
+	#############################################################################
+
+	def loadJournal(self):
+
+		if not self.journalPath.is_file():
+
+			return
+
+		with open(self.journalPath, 'rb') as f:
+
+			data = f.read()
+
+		whole = len(data) - len(data) % self.width
+
+		if whole != len(data):
+
+			with open(self.journalPath, 'r+b') as f:
+
+				f.truncate(whole) # Torn final record from a crash mid write
+
+		for offset in range(0, whole, self.width):
+
+			entry = data[offset:offset + self.width]
+
+			if not self.indexed(entry):
+
+				self.pending.add(entry)
+
+	#############################################################################
+
+	def indexed(self, entry):
+
+		lo, hi = 0, self.indexCount
+
+		while lo < hi:
+
+			mid = (lo + hi) // 2
+
+			probe = self.index[mid * self.width:(mid + 1) * self.width]
+
+			if probe == entry:
+
+				return True
+
+			if probe < entry:
+
+				lo = mid + 1
+
+			else:
+
+				hi = mid
+
+		return False
+
+	#############################################################################
+
+	def __contains__(self, entry):
+
+		return entry in self.pending or self.indexed(entry)
+
+	#############################################################################
+
+	def __len__(self):
+
+		return self.indexCount + len(self.pending)
+
+	#############################################################################
+
+	def __iter__(self):
+
+		for offset in range(0, self.indexCount * self.width, self.width):
+
+			yield self.index[offset:offset + self.width]
+
+		yield from self.pending
+
+	#############################################################################
+
+	def add(self, entry):
+
+		if len(entry) != self.width:
+
+			raise ValueError('HashStore entries must be {} bytes'.format(self.width))
+
+		if entry in self:
+
+			return False
+
+		self.pending.add(entry)
+
+		self.batch.append(entry)
+
+		return True
+
+	#############################################################################
+
+	def needs_compaction(self):
+
+		return len(self.pending) >= max(self.compactMinimum, self.indexCount * self.compactFraction)
+
+	#############################################################################
+
+	def take_batch(self, compact = None):
+
+		# Hand new entries to write_batch() - when compacting the pending entries to fold into the index go too
+
+		if compact is None:
+
+			compact = self.needs_compaction()
+
+		batch, self.batch = b''.join(self.batch), []
+
+		return (batch, sorted(self.pending) if compact else None)
+
+	#############################################################################
+
+	def write_batch(self, work):
+
+		# Append and fsync the batch, then optionally merge the journalled entries into a new index
+		# The journal holds exactly the merged entries at that point, so it is emptied once the index is in place
+
+		batch, merge = work
+
+		if batch:
+
+			with open(self.journalPath, 'ab') as f:
+
+				f.write(batch)
+
+				f.flush()
+
+				os.fsync(f.fileno())
+
+		if merge is None:
+
+			return None
+
+		temp = self.indexPath.with_suffix('.tmp')
+
+		with open(temp, 'wb') as f:
+
+			old, new = 0, 0
+
+			while old < self.indexCount or new < len(merge):
+
+				if new == len(merge) or (old < self.indexCount and self.index[old * self.width:(old + 1) * self.width] < merge[new]):
+
+					f.write(self.index[old * self.width:(old + 1) * self.width])
+
+					old += 1
+
+				else:
+
+					f.write(merge[new])
+
+					new += 1
+
+			f.flush()
+
+			os.fsync(f.fileno())
+
+		os.replace(temp, self.indexPath)
+
+		with open(self.journalPath, 'r+b') as f:
+
+			f.truncate(0)
+
+			os.fsync(f.fileno())
+
+		return merge
+
+	#############################################################################
+
+	def write_failed(self, work):
+
+		# Owner's thread - the batch goes back in front of anything added since so it is retried in order
+
+		batch, merge = work
+
+		self.batch[:0] = [batch[offset:offset + self.width] for offset in range(0, len(batch), self.width)]
+
+	#############################################################################
+
+	def compacted(self, merged):
+
+		# Owner's thread - switch to the new index and drop what it now holds from the pending set
+
+		if merged:
+
+			self.openIndex()
+
+			self.pending.difference_update(merged)
+
+	#############################################################################
+
+	def close(self):
+
+		if self.index:
+
+			self.index.close()
+
+			self.index = None
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+import hashlib
+import math
+
+################################################################################
+
+class HyperLogLog():
+
+	# Cardinality estimator in a fixed 2**precision byte register array - standard error ~1.04/sqrt(2**precision)
+	# Values are hashed with SHA-256; callers that already hold a digest can use add_hash()
+
+	#############################################################################
+
+	def __init__(self, precision = 14, registers = None):
+
+		if not 4 <= precision <= 18:
+
+			raise ValueError('HyperLogLog precision must be between 4 and 18')
+
+		self.precision = precision
+		self.size      = 1 << precision
+		self.registers = bytearray(registers) if registers is not None else bytearray(self.size)
+		self.estimate  = None		# Cached count(), cleared when a register changes
+
+		if len(self.registers) != self.size:
+
+			raise ValueError('HyperLogLog register array does not match precision')
+
+	#############################################################################
+
+	def add(self, value):
+
+		return self.add_hash(hashlib.sha256(value.encode()).digest())
+
+	#############################################################################
+
+	def add_hash(self, digest):
+
+		# Returns True when a register changed, ie. when a save is worthwhile
+
+		bits  = int.from_bytes(digest[:8], 'big')
+
+		index = bits >> (64 - self.precision)
+
+		rest  = bits & ((1 << (64 - self.precision)) - 1)
+
+		rank  = (64 - self.precision) - rest.bit_length() + 1
+
+		if rank > self.registers[index]:
+
+			self.registers[index] = rank
+
+			self.estimate = None
+
+			return True
+
+		return False
+
+	#############################################################################
+
+	def count(self):
+
+		if self.estimate is None:
+
+			alpha = 0.7213 / (1 + 1.079 / self.size)
+
+			estimate = alpha * self.size * self.size / math.fsum(2.0 ** -rank for rank in self.registers)
+
+			zeros = self.registers.count(0)
+
+			if estimate <= 2.5 * self.size and zeros:
+
+				estimate = self.size * math.log(self.size / zeros) # Small range - linear counting is more accurate
+
+			self.estimate = estimate
+
+		return self.estimate
+
+	#############################################################################
+
+	def merge(self, other):
+
+		if other.precision != self.precision:
+
+			raise ValueError('HyperLogLog precision mismatch')
+
+		self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+		self.estimate  = None
+
+	#############################################################################
+
+	def to_bytes(self):
+
+		return bytes([self.precision]) + bytes(self.registers)
+
+	#############################################################################
+
+	@classmethod
+	def from_bytes(cls, data):
+
+		return cls(data[0], data[1:])
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+import functools
+import threading
+import logging
+import time
+
+from collections import deque
+
+################################################################################
+
+def callback_name(callback):
+
+	# Qualified name for log lines - unwraps partials and names bound methods by class
+
+	while isinstance(callback, functools.partial):
+
+		callback = callback.func
+
+	name = getattr(callback, '__qualname__', None) or type(callback).__qualname__
+
+	module = getattr(callback, '__module__', None)
+
+	return '{}.{}'.format(module, name) if module else name
+
+################################################################################
+
+class LoopMonitor():
+
+	# Event loop health - how late timers fire and how long each callback holds the loop
+	# Samples are kept in rolling windows so percentiles reflect recent behaviour
+	# Recording happens on the loop thread, snapshots may be taken from a stats timer thread
+
+	#############################################################################
+
+	def __init__(self, name = 'loop', threshold = 0.1, window = 1024):
+
+		self.name      = name
+		self.threshold = threshold		# Callbacks taking longer than this (seconds) are logged, None = never
+		self.window    = window
+		self.lock      = threading.Lock()
+
+		self.reset()
+
+	#############################################################################
+
+	def reset(self):
+
+		self.lag     = deque(maxlen = self.window)
+		self.wall    = {}				# kind : deque of callback durations
+		self.calls   = {}				# kind : callbacks run
+		self.slow    = {}				# kind : callbacks over threshold
+		self.maximum = {}				# kind : (duration, name) of the slowest callback
+
+	#############################################################################
+
+	def record_lag(self, seconds):
+
+		# Lateness of a timer - actual minus scheduled firing time
+
+		with self.lock:
+
+			self.lag.append(max(0.0, seconds))
+
+	#############################################################################
+
+	def call(self, kind, callback, *args):
+
+		start = time.perf_counter()
+
+		try:
+
+			return callback(*args)
+
+		finally:
+
+			self.record_call(kind, callback, time.perf_counter() - start)
+
+	#############################################################################
+
+	def record_call(self, kind, callback, seconds):
+
+		slow = self.threshold is not None and seconds > self.threshold
+
+		with self.lock:
+
+			if kind not in self.wall:
+
+				self.wall[kind]  = deque(maxlen = self.window)
+				self.calls[kind] = 0
+				self.slow[kind]  = 0
+
+			self.wall[kind].append(seconds)
+
+			self.calls[kind] += 1
+
+			self.slow[kind]  += slow
+
+			if seconds > self.maximum.get(kind, (0.0, ''))[0]:
+
+				self.maximum[kind] = (seconds, callback_name(callback))
+
+		if slow:
+
+			logging.warning('{} : slow {} callback {} took {:.3f}s'.format(self.name, kind, callback_name(callback), seconds))
+
+	#############################################################################
+
+	@staticmethod
+	def percentiles(samples, fractions = (0.5, 0.9, 0.99)):
+
+		ordered = sorted(samples)
+
+		if not ordered:
+
+			return [0.0 for fraction in fractions]
+
+		return [ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] for fraction in fractions]
+
+	#############################################################################
+
+	def snapshot(self, reset = False):
+
+		with self.lock:
+
+			result = {'lag' : dict(zip(('p50', 'p90', 'p99'), self.percentiles(self.lag)), samples = len(self.lag))}
+
+			for kind, samples in self.wall.items():
+
+				result[kind] = dict(zip(('p50', 'p90', 'p99'), self.percentiles(samples)),
+									calls   = self.calls[kind],
+									slow    = self.slow[kind],
+									maximum = self.maximum.get(kind, (0.0, ''))[0],
+									slowest = self.maximum.get(kind, (0.0, ''))[1])
+
+			if reset:
+
+				self.reset()
+
+		return result
+
+	#############################################################################
+
+	def snapshot_lines(self, reset = False):
+
+		lines = []
+
+		for kind, entry in self.snapshot(reset).items():
+
+			if kind == 'lag':
+
+				lines.append('{} timer lag p50={:.1f}ms p90={:.1f}ms p99={:.1f}ms ({:d} samples)'.format(self.name, entry['p50'] * 1000, entry['p90'] * 1000, entry['p99'] * 1000, entry['samples']))
+
+			else:
+
+				lines.append('{} {} calls={:d} slow={:d} p50={:.1f}ms p90={:.1f}ms p99={:.1f}ms max={:.1f}ms {}'.format(self.name, kind, entry['calls'], entry['slow'], entry['p50'] * 1000, entry['p90'] * 1000, entry['p99'] * 1000, entry['maximum'] * 1000, entry['slowest']))
+
+		return lines
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# coding: UTF-8
+
+import argparse
+import logging
+import math
+import time
+
+from collections import OrderedDict
+
+################################################################################
+
+def rate_spec(text):
+
+	# argparse type for method=rate[:burst] - rate in packets per second, burst defaults to the rate rounded up
+
+	try:
+
+		meth, value = text.split('=')
+
+		rate, burst = value.split(':') if ':' in value else (value, None)
+
+		rate  = float(rate)
+
+		burst = float(burst) if burst is not None else float(max(1, math.ceil(rate)))
+
+	except ValueError:
+
+		raise argparse.ArgumentTypeError('rate must be method=rate[:burst]')
+
+	if rate <= 0 or burst < 1:
+
+		raise argparse.ArgumentTypeError('rate must be positive and burst at least 1')
+
+	return (meth, rate, burst)
+
+################################################################################
+
+class RateLimiter():
+
+	# Token bucket admission control keyed by sender and method
+	# Buckets are kept in LRU order and the least recently seen sender is forgotten beyond capacity
+	# Runs on the event loop thread only
+
+	#############################################################################
+
+	def __init__(self, name = 'rate', rates = None, default = None, capacity = 10000, clock = time.monotonic):
+
+		self.name     = name
+		self.rates    = dict(rates or {})	# meth : (rate per second, burst)
+		self.default  = default				# (rate, burst) for other methods, None = unlimited
+		self.capacity = capacity
+		self.clock    = clock
+		self.buckets  = OrderedDict()		# (tag, meth) : [tokens, last refill, dropping]
+
+		self.reset()
+
+	#############################################################################
+
+	def reset(self):
+
+		self.allowed = {}					# meth : packets admitted
+		self.dropped = {}					# meth : packets dropped
+		self.evicted = 0					# buckets forgotten to stay within capacity
+
+	#############################################################################
+
+	def allow(self, tag, meth):
+
+		limit = self.rates.get(meth, self.default)
+
+		if limit is None:
+
+			return True
+
+		rate, burst = limit
+
+		now = self.clock()
+
+		key = (tag, meth)
+
+		bucket = self.buckets.get(key)
+
+		if bucket is None:
+
+			bucket = self.buckets[key] = [burst, now, False]
+
+			if len(self.buckets) > self.capacity:
+
+				self.buckets.popitem(last = False)
+
+				self.evicted += 1
+
+		else:
+
+			self.buckets.move_to_end(key)
+
+			bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+
+			bucket[1] = now
+
+		if bucket[0] >= 1.0:
+
+			bucket[0] -= 1.0
+
+			bucket[2]  = False
+
+			self.allowed[meth] = self.allowed.get(meth, 0) + 1
+
+			return True
+
+		if not bucket[2]:
+
+			bucket[2] = True	# Log once as a sender starts being limited, not for every dropped packet
+
+			logging.info('{} : limiting {} from {}'.format(self.name, meth, tag))
+
+		self.dropped[meth] = self.dropped.get(meth, 0) + 1
+
+		return False
+
+	#############################################################################
+
+	def snapshot_lines(self, reset = False):
+
+		lines = ['{} {} allowed={:d} dropped={:d}'.format(self.name, meth, self.allowed.get(meth, 0), self.dropped.get(meth, 0)) for meth in sorted(set(self.allowed) | set(self.dropped))]
+
+		lines.append('{} buckets={:d} evicted={:d}'.format(self.name, len(self.buckets), self.evicted))
+
+		if reset:
+
+			self.reset()
+
+		return lines
@@ -14,4 +14,6 @@
 """
 
 from .rpc import Proxy
+from .multi import MultiProxy, RpcFuture
+from .stats import RpcStats
 from . import exc
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright (C) 2017 Oleksii Ivanchuk
+
+  This file is part of slick-bitcoinrpc.
+  It is subject to the license terms in the LICENSE file found in the
+  top-level
+  directory of this distribution.
+
+  No part of slick-bitcoinrpc, including this file, may be copied, modified,
+  propagated, or distributed except according to the terms contained in the
+  LICENSE file
+"""
+
+"""
+  Non-blocking JSON-RPC over pycurl.CurlMulti.
+
+  Calls return an RpcFuture immediately. Completion is driven either by an
+  attached event loop, which watches the curl sockets and timer, or by
+  calling wait() from a thread that is allowed to block.
+
+  The event loop must provide:
+
+    watch_fd(fd, callback, flags)   - callback(fd, events) on readiness
+    remove_watch_fd(fd)
+    alarm(seconds, callback)        - returns a handle
+    remove_alarm(handle)
+"""
+
+from collections import deque
+import ujson
+
+import pycurl
+
+try:
+    from cStringIO import StringIO
+except:
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import BytesIO as StringIO
+
+from .exc import RpcException
+from .rpc import Proxy, DEFAULT_HTTP_TIMEOUT, DEFAULT_MAX_CONNECTIONS
+from .stats import RpcStats
+
+
+class RpcFuture(object):
+    """
+      Result of an asynchronous call. Callbacks run on the thread that
+      drives the CurlMulti - the event loop thread when attached - and
+      exceptions raised by callbacks propagate to that thread.
+    """
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self._done = False
+        self._value = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self):
+        if not self._done:
+            raise RuntimeError('%s: call still in flight' % self.method)
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def exception(self):
+        return self._error
+
+    def add_done_callback(self, callback):
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, value):
+        self._value = value
+        self._complete()
+
+    def set_exception(self, error):
+        self._error = error
+        self._complete()
+
+    def _complete(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class MultiProxy(object):
+
+    def __init__(self,
+                 service_url=None,
+                 service_port=None,
+                 conf_file=None,
+                 timeout=DEFAULT_HTTP_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.config = Proxy.load_config(service_url, service_port, conf_file)
+        self.timeout = timeout
+        self.max_connections = max(1, max_connections)
+        self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self._on_socket)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self._on_timer)
+        self._idle = []
+        self._created = 0
+        self._active = {}        # curl handle -> (future, body)
+        self._queued = deque()   # (future, postdata) awaiting a free handle
+        self._loop = None
+        self._timer = None
+        self._fds = set()
+        self.stats = RpcStats()
+
+    def __getattr__(self, method):
+        if method.startswith('__'):
+            raise AttributeError(method)
+        def call(*params):
+            future = RpcFuture(method, params)
+            postdata = ujson.dumps({"jsonrpc": "2.0",
+                                    "method": method,
+                                    "params": params,
+                                    "id": next(Proxy._ids)})
+            self._queued.append((future, postdata))
+            self._start_queued()
+            return future
+        return call
+
+    def in_flight(self):
+        return len(self._active) + len(self._queued)
+
+    def attach(self, loop):
+        self._loop = loop
+
+    def detach(self):
+        for fd in self._fds:
+            self._loop.remove_watch_fd(fd)
+        self._fds.clear()
+        if self._timer is not None:
+            self._loop.remove_alarm(self._timer)
+            self._timer = None
+        self._loop = None
+
+    def wait(self, timeout=1.0):
+        """
+          Block until every call in flight has completed - for use without
+          an attached event loop.
+        """
+        while self.in_flight():
+            while self.multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                pass
+            self._check_done()
+            if self._active:
+                self.multi.select(timeout)
+
+    def _start_queued(self):
+        while self._queued:
+            if self._idle:
+                conn = self._idle.pop()
+            elif self._created < self.max_connections:
+                conn = Proxy.prepare_connection(self.config, timeout=self.timeout)
+                self._created += 1
+            else:
+                return
+            future, postdata = self._queued.popleft()
+            body = StringIO()
+            conn.setopt(conn.WRITEFUNCTION, body.write)
+            conn.setopt(conn.POSTFIELDS, postdata)
+            self._active[conn] = (future, body, len(postdata))
+            self.multi.add_handle(conn)
+
+    def _on_socket(self, what, fd, multi, socketp):
+        if self._loop is None:
+            return
+        if what == pycurl.POLL_REMOVE:
+            if fd in self._fds:
+                self._fds.discard(fd)
+                self._loop.remove_watch_fd(fd)
+        else:
+            # curl POLL_IN/POLL_OUT share values with zmq POLLIN/POLLOUT
+            self._fds.add(fd)
+            self._loop.watch_fd(fd, self._on_ready, what)
+
+    def _on_timer(self, timeout_ms):
+        if self._loop is None:
+            return
+        if self._timer is not None:
+            self._loop.remove_alarm(self._timer)
+            self._timer = None
+        if timeout_ms >= 0:
+            self._timer = self._loop.alarm(timeout_ms / 1000.0, self._on_timeout)
+
+    def _on_timeout(self):
+        self._timer = None
+        self.multi.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+        self._check_done()
+
+    def _on_ready(self, fd, events):
+        # zmq POLLIN/POLLOUT/POLLERR share values with curl CSELECT_IN/OUT/ERR
+        self.multi.socket_action(fd, events)
+        self._check_done()
+
+    def _check_done(self):
+        completed = []
+        while True:
+            queued, ok_list, err_list = self.multi.info_read()
+            for conn in ok_list:
+                completed.append((conn, None))
+            for conn, errno, errmsg in err_list:
+                completed.append((conn, pycurl.error(errno, errmsg)))
+            if queued == 0:
+                break
+        for conn, error in completed:
+            self.multi.remove_handle(conn)
+            future, body, bytes_out = self._active.pop(conn)
+            self.stats.record_transfer((future.method,), None if error else conn,
+                                       bytes_out, len(body.getvalue()), error)
+            self._idle.append(conn)
+            self._start_queued()
+            if error is None:
+                try:
+                    resp = ujson.loads(body.getvalue())
+                except ValueError as decode_error:
+                    error = decode_error
+                else:
+                    if resp.get('error') is not None:
+                        error = RpcException(resp['error'], future.method, future.params)
+                        self.stats.record_error(future.method, error)
+            if error is None:
+                future.set_result(resp['result'])
+            else:
+                future.set_exception(error)
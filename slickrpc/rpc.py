@@ -14,6 +14,7 @@
 """
 
 from itertools import count
+import threading
 import ujson
 
 import base64
@@ -34,9 +35,11 @@ except:
         from io import BytesIO as StringIO
 
 from .exc import RpcException
+from .stats import RpcStats
 
 DEFAULT_HTTP_TIMEOUT = 30
 DEFAULT_RPC_PORT = 19119 # Default RPC port for eccoin
+DEFAULT_MAX_CONNECTIONS = 8
 
 
 class Proxy(object):
@@ -46,36 +49,95 @@ class Proxy(object):
                  service_url=None,
                  service_port=None,
                  conf_file=None,
-                 timeout=DEFAULT_HTTP_TIMEOUT):
-        config = dict()
-        if conf_file:
-            config = ConfigObj(conf_file)
-        if service_url:
-            config.update(self.url_to_conf(service_url))
-        if service_port:
-            config.update(rpcport=service_port)
-        elif not config.get('rpcport'):
-            config['rpcport'] = DEFAULT_RPC_PORT
-        self.conn = self.prepare_connection(config, timeout=timeout)
+                 timeout=DEFAULT_HTTP_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS):
+        config = self.load_config(service_url, service_port, conf_file)
+        self.config = config
+        self.timeout = timeout
+        # Pool of curl handles - a handle is lent to one thread per call
+        self.max_connections = max(1, max_connections)
+        self._idle = [self.prepare_connection(config, timeout=timeout)]
+        self._created = 1
+        self._pool_cond = threading.Condition()
+        self.stats = RpcStats()
 
     def __getattr__(self, method):
-        conn = self.conn
         id = next(self._ids)
         def call(*params):
             postdata = ujson.dumps({"jsonrpc": "2.0",
                                     "method": method,
                                     "params": params,
                                     "id": id})
-            body = StringIO()
-            conn.setopt(conn.WRITEFUNCTION, body.write)
-            conn.setopt(conn.POSTFIELDS, postdata)
-            conn.perform()
-            resp = ujson.loads(body.getvalue())
+            resp = self._post(postdata, (method,))
             if resp.get('error') is not None:
-                raise RpcException(resp['error'], method, params)
+                error = RpcException(resp['error'], method, params)
+                self.stats.record_error(method, error)
+                raise error
             return resp['result']
         return call
 
+    def _post(self, postdata, methods):
+        conn = self._acquire()
+        try:
+            body = StringIO()
+            conn.setopt(conn.WRITEFUNCTION, body.write)
+            conn.setopt(conn.POSTFIELDS, postdata)
+            try:
+                conn.perform()
+            except Exception as error:
+                self.stats.record_transfer(methods, None, len(postdata), 0, error)
+                raise
+            self.stats.record_transfer(methods, conn, len(postdata), len(body.getvalue()))
+        finally:
+            self._release(conn)
+        return ujson.loads(body.getvalue())
+
+    def _acquire(self):
+        with self._pool_cond:
+            while not self._idle:
+                if self._created < self.max_connections:
+                    self._created += 1
+                    break
+                self._pool_cond.wait()
+            else:
+                return self._idle.pop()
+        try:
+            return self.prepare_connection(self.config, timeout=self.timeout)
+        except:
+            with self._pool_cond:
+                self._created -= 1
+                self._pool_cond.notify()
+            raise
+
+    def _release(self, conn):
+        with self._pool_cond:
+            self._idle.append(conn)
+            self._pool_cond.notify()
+
+    def batch(self):
+        """
+          Collect calls and send them as one JSON-RPC array on exit:
+
+            with proxy.batch() as b:
+                blocks = b.getblockcount()
+                peers = b.getconnectioncount()
+            blocks.result()
+        """
+        return Batch(self)
+
+    @classmethod
+    def load_config(cls, service_url=None, service_port=None, conf_file=None):
+        config = dict()
+        if conf_file:
+            config = ConfigObj(conf_file)
+        if service_url:
+            config.update(cls.url_to_conf(service_url))
+        if service_port:
+            config.update(rpcport=service_port)
+        elif not config.get('rpcport'):
+            config['rpcport'] = DEFAULT_RPC_PORT
+        return config
+
     @classmethod
     def prepare_connection(cls, conf, timeout=DEFAULT_HTTP_TIMEOUT):
         url = 'http://%s:%s' % (conf['rpchost'], conf['rpcport'])
@@ -97,3 +159,69 @@ class Proxy(object):
         url = urlparse.urlparse(service_url)
         return dict(rpchost=url.hostname, rpcport=url.port,
                     rpcuser=url.username, rpcpassword=url.password)
+
+
+class BatchCall(object):
+    __slots__ = ('method', 'params', 'id', 'done', 'value', 'error')
+
+    def __init__(self, method, params, id):
+        self.method = method
+        self.params = params
+        self.id = id
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def result(self):
+        if not self.done:
+            raise RuntimeError('%s: batch not yet executed' % self.method)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class Batch(object):
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._calls = []
+
+    def __getattr__(self, method):
+        if method.startswith('__'):
+            raise AttributeError(method)
+        def call(*params):
+            one = BatchCall(method, params, next(self._proxy._ids))
+            self._calls.append(one)
+            return one
+        return call
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        return False
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        if not calls:
+            return calls
+        postdata = ujson.dumps([{"jsonrpc": "2.0",
+                                 "method": one.method,
+                                 "params": one.params,
+                                 "id": one.id} for one in calls])
+        resp = self._proxy._post(postdata, [one.method for one in calls])
+        if isinstance(resp, dict):
+            # Whole batch rejected - report the error against every call
+            resp = [dict(resp, id=one.id) for one in calls]
+        by_id = dict((each.get('id'), each) for each in resp)
+        for one in calls:
+            each = by_id.get(one.id, {'error': {'code': -32603,
+                                                'message': 'missing from batch response'}})
+            if each.get('error') is not None:
+                one.error = RpcException(each['error'], one.method, one.params)
+                self._proxy.stats.record_error(one.method, one.error)
+            else:
+                one.value = each.get('result')
+            one.done = True
+        return calls
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright (C) 2017 Oleksii Ivanchuk
+
+  This file is part of slick-bitcoinrpc.
+  It is subject to the license terms in the LICENSE file found in the
+  top-level
+  directory of this distribution.
+
+  No part of slick-bitcoinrpc, including this file, may be copied, modified,
+  propagated, or distributed except according to the terms contained in the
+  LICENSE file
+"""
+
+"""
+  Per-method call, error, byte and latency accounting for RPC proxies.
+  Latencies come from pycurl timing info (seconds).
+"""
+
+import threading
+
+import pycurl
+
+# Upper bounds of the latency histogram buckets in seconds - the last bucket is open ended
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class MethodStats(object):
+    __slots__ = ('calls', 'errors', 'bytes_out', 'bytes_in',
+                 'connect', 'pretransfer', 'total', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = {}
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.connect = 0.0
+        self.pretransfer = 0.0
+        self.total = 0.0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the requested fraction of calls
+        timed = sum(self.histogram)
+        if not timed:
+            return 0.0
+        rank = fraction * timed
+        seen = 0
+        for bound, hits in zip(LATENCY_BUCKETS, self.histogram):
+            seen += hits
+            if seen >= rank:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+    def snapshot(self):
+        timed = sum(self.histogram)
+        return {'calls': self.calls,
+                'errors': dict(self.errors),
+                'bytes_out': self.bytes_out,
+                'bytes_in': self.bytes_in,
+                'connect_avg': self.connect / timed if timed else 0.0,
+                'pretransfer_avg': self.pretransfer / timed if timed else 0.0,
+                'total_avg': self.total / timed if timed else 0.0,
+                'p50': self.percentile(0.50),
+                'p90': self.percentile(0.90),
+                'p99': self.percentile(0.99),
+                'histogram': list(zip(LATENCY_BUCKETS, self.histogram))}
+
+
+class RpcStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def _method(self, method):
+        stats = self._methods.get(method)
+        if stats is None:
+            stats = self._methods[method] = MethodStats()
+        return stats
+
+    def record_transfer(self, methods, conn, bytes_out, bytes_in, error=None):
+        """
+          Account one HTTP round trip carrying one call per entry in methods.
+          Bytes are shared between the calls, latency is charged to each.
+        """
+        if conn is not None and error is None:
+            timing = (conn.getinfo(pycurl.CONNECT_TIME),
+                      conn.getinfo(pycurl.PRETRANSFER_TIME),
+                      conn.getinfo(pycurl.TOTAL_TIME))
+        else:
+            timing = None
+        share = max(1, len(methods))
+        with self._lock:
+            for method in methods:
+                stats = self._method(method)
+                stats.calls += 1
+                stats.bytes_out += bytes_out // share
+                stats.bytes_in += bytes_in // share
+                if error is not None:
+                    name = type(error).__name__
+                    stats.errors[name] = stats.errors.get(name, 0) + 1
+                if timing is not None:
+                    stats.connect += timing[0]
+                    stats.pretransfer += timing[1]
+                    stats.total += timing[2]
+                    for index, bound in enumerate(LATENCY_BUCKETS):
+                        if timing[2] <= bound:
+                            stats.histogram[index] += 1
+                            break
+
+    def record_error(self, method, error):
+        name = type(error).__name__
+        with self._lock:
+            stats = self._method(method)
+            stats.errors[name] = stats.errors.get(name, 0) + 1
+
+    def snapshot(self, reset=False):
+        with self._lock:
+            result = dict((method, stats.snapshot())
+                          for method, stats in self._methods.items())
+            if reset:
+                self._methods = {}
+        return result
+
+    @staticmethod
+    def format_snapshot(snapshot):
+        """
+          One log line per method, busiest first.
+        """
+        lines = []
+        for method, one in sorted(snapshot.items(),
+                                  key=lambda item: -item[1]['calls'] * item[1]['total_avg']):
+            errors = ','.join('%s=%d' % error for error in sorted(one['errors'].items()))
+            lines.append('%s calls=%d errors=%d%s out=%dB in=%dB '
+                         'avg=%.1fms connect=%.1fms pretransfer=%.1fms '
+                         'p50<=%gms p90<=%gms p99<=%gms' %
+                         (method, one['calls'], sum(one['errors'].values()),
+                          ' (%s)' % errors if errors else '',
+                          one['bytes_out'], one['bytes_in'],
+                          one['total_avg'] * 1000, one['connect_avg'] * 1000,
+                          one['pretransfer_avg'] * 1000,
+                          one['p50'] * 1000, one['p90'] * 1000, one['p99'] * 1000))
+        return lines
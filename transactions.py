@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 # coding: UTF-8
 
+import logging
+
 from datetime   import datetime
+from functools  import partial
 from eccpacket  import eccPacket
 from cryptonode import cryptoNode, eccoinNode, bitcoinNode, moneroNode, cryptoNodeException
 
@@ -80,7 +83,7 @@ class txChat():
 
 			self.parent.send_ecresolve_packet(eccPacket.METH_nameReq, data)
 
-			self.parent.loop.set_alarm_in(5, self.do_resolve_timeout)
+			self.parent.set_timeout(5, self.do_resolve_timeout)
 
 	############################################################################
 
@@ -130,7 +133,7 @@ class txChat():
 
 				self.parent.append_message(0, 'Chat request sent to: {}'.format(self.name))
 
-				self.parent.loop.set_alarm_in(5, self.do_request_timeout)
+				self.parent.set_timeout(5, self.do_request_timeout)
 
 			else:
 
@@ -144,7 +147,7 @@ class txChat():
 
 			self.parent.append_message(0, 'Waiting for chat request to be accepted by: {}'.format(self.name))
 
-			self.parent.loop.set_alarm_in(5, self.do_request_timeout)
+			self.parent.set_timeout(5, self.do_request_timeout)
 
 	############################################################################
 
@@ -181,12 +184,14 @@ class txSend():
 	STATE_initial	= 1
 	STATE_checking	= 2
 	STATE_addr_req	= 3
-	STATE_complete	= 4
-	STATE_failure	= 5
+	STATE_sending	= 4
+	STATE_complete	= 5
+	STATE_failure	= 6
 
 	STATE_SET = [STATE_initial,
 				 STATE_checking,
 				 STATE_addr_req,
+				 STATE_sending,
 				 STATE_complete,
 				 STATE_failure]
 
@@ -220,9 +225,25 @@ class txSend():
 
 	############################################################################
 
+	def expect_state(self, state, event):
+
+		# Completions arrive from workers and peers - a late or duplicate one is logged and ignored
+
+		if self.tx_state == state:
+
+			return True
+
+		logging.info('txSend {} : {} ignored in state {}'.format(self.uuid, event, self.tx_state))
+
+		return False
+
+	############################################################################
+
 	def do_checks(self):
 
-		assert self.tx_state == self.STATE_initial
+		if not self.expect_state(self.STATE_initial, 'do_checks'):
+
+			return
 
 		self.tx_state = self.STATE_checking
 
@@ -246,13 +267,19 @@ class txSend():
 
 			return
 
-		# Check 3 - Does the user's wallet hold an adequate balance ?
+		# Check 3 - Does the user's wallet hold an adequate balance ? (wallet RPCs continue off the event loop)
 
-		try:
+		self.coin.call_async(self.do_balance_check, self.coin.get_unlocked_balance)
+
+	############################################################################
+
+	def do_balance_check(self, balance, error):
 
-			balance = self.coin.get_unlocked_balance()
+		if not self.expect_state(self.STATE_checking, 'do_balance_check'):
+
+			return
 
-		except cryptoNodeException as error:
+		if error:
 
 			self.do_failure(str(error))
 
@@ -272,9 +299,27 @@ class txSend():
 
 	def do_wallet_unlocked_check(self):
 
-		assert self.tx_state == self.STATE_checking
+		if not self.expect_state(self.STATE_checking, 'do_wallet_unlocked_check'):
+
+			return
+
+		self.coin.call_async(self.do_wallet_locked_result, partial(self.coin.wallet_locked, cache_prior_state = (self.unlRetry == 0)))
+
+	############################################################################
+
+	def do_wallet_locked_result(self, locked, error):
+
+		if not self.expect_state(self.STATE_checking, 'do_wallet_locked_result'):
+
+			return
+
+		if error:
+
+			self.do_failure(str(error))
+
+			return
 
-		if self.coin.wallet_locked(cache_prior_state = (self.unlRetry == 0)):
+		if locked:
 
 			self.unlRetry += 1
 
@@ -294,15 +339,19 @@ class txSend():
 
 	def passphrase_callback(self, status, passphrase):
 
-		assert self.tx_state == self.STATE_checking
+		if not self.expect_state(self.STATE_checking, 'passphrase_callback'):
+
+			return
 
 		if status:
 
 			if passphrase:
 
-				self.coin.unlock_wallet(passphrase, 60)
+				self.coin.call_async(lambda unlocked, error: self.do_wallet_unlocked_check(), self.coin.unlock_wallet, passphrase, 60)
+
+			else:
 
-			self.do_wallet_unlocked_check()
+				self.do_wallet_unlocked_check()
 
 		else:
 
@@ -312,7 +361,9 @@ class txSend():
 
 	def do_addr_req(self):
 
-		assert self.tx_state == self.STATE_checking
+		if not self.expect_state(self.STATE_checking, 'do_addr_req'):
+
+			return
 
 		self.tx_state = self.STATE_addr_req		
 
@@ -324,7 +375,7 @@ class txSend():
 
 		self.parent.send_ecchat_packet(eccPacket.METH_addrReq, data)
 
-		self.parent.loop.set_alarm_in(10, self.do_addr_req_timeout)
+		self.parent.set_timeout(10, self.do_addr_req_timeout)
 
 	############################################################################
 
@@ -340,7 +391,9 @@ class txSend():
 
 	def do_send(self, addr):
 
-		assert self.tx_state == self.STATE_addr_req
+		if not self.expect_state(self.STATE_addr_req, 'do_send'):
+
+			return
 
 		self.addr = addr
 
@@ -352,39 +405,57 @@ class txSend():
 			
 			return
 
-		if (self.tx_state == self.STATE_addr_req) and addr != '0':
+		self.tx_state = self.STATE_sending
 
-			try:
+		self.coin.call_async(self.do_send_result, self.send_and_relock, addr, str(self.f_amount))
 
-				self.txid = self.coin.send_to_address(addr, str(self.f_amount), "ecchat")
+	############################################################################
 
-				self.coin.revert_wallet_lock()
+	def send_and_relock(self, addr, amount):
 
-			except cryptoNodeException as error:
+		# Worker pool - both calls block on the wallet
 
-				self.do_failure(str(error))
+		txid = self.coin.send_to_address(addr, amount, "ecchat")
 
-				return
+		self.coin.revert_wallet_lock()
 
-			else:
+		return txid
+
+	############################################################################
+
+	def do_send_result(self, txid, error):
 
-				self.time_tx  = datetime.now()
+		if not self.expect_state(self.STATE_sending, 'do_send_result'):
 
-				self.parent.append_message(0, '{:f} {} sent to {}'.format(self.f_amount, self.coin.symbol, self.addr))
+			return
 
-				# Send the METH_txidInf message - (uuid, coin, amount, address, txid)
+		if error:
 
-				data = {'uuid' : self.uuid,
-						'coin' : self.coin.symbol,
-						'amnt' : '{:f}'.format(self.f_amount),
-						'addr' : self.addr,
-						'txid' : self.txid}
+			self.do_failure(str(error))
+
+			return
+
+		else:
+
+			self.txid = txid
+
+			self.time_tx  = datetime.now()
+
+			self.parent.append_message(0, '{:f} {} sent to {}'.format(self.f_amount, self.coin.symbol, self.addr))
+
+			# Send the METH_txidInf message - (uuid, coin, amount, address, txid)
+
+			data = {'uuid' : self.uuid,
+					'coin' : self.coin.symbol,
+					'amnt' : '{:f}'.format(self.f_amount),
+					'addr' : self.addr,
+					'txid' : self.txid}
 
-				self.parent.send_ecchat_packet(eccPacket.METH_txidInf, data)
+			self.parent.send_ecchat_packet(eccPacket.METH_txidInf, data)
 
-				self.parent.txid = self.txid # TIDY
+			self.parent.txid = self.txid # TIDY
 
-				self.tx_state = self.STATE_complete
+			self.tx_state = self.STATE_complete
 
 ################################################################################
 ## txReceive class #############################################################
@@ -3,33 +3,258 @@
 
 import urwid
 import heapq
+import errno
+import math
 import time
+import zlib
 import zmq
 import os
 
-from itertools import count
+from collections import deque
+from itertools   import count
+
+from concurrent.futures import ThreadPoolExecutor
 
 from urwid.main_loop import EventLoop
 
+from loopmonitor import LoopMonitor
+
 zmq_magic = 99999
 
 ################################################################################
 
+class WheelTimer():
+
+	__slots__ = ('expiry', 'callback', 'args', 'slot')
+
+	def __init__(self, expiry, callback, args):
+
+		self.expiry   = expiry		# Absolute tick at which the timer fires
+		self.callback = callback
+		self.args     = args
+		self.slot     = None		# Wheel slot currently holding the timer, None once fired or cancelled
+
+################################################################################
+
+class TimingWheel():
+
+	# Hierarchical timing wheel - O(1) schedule and cancel, expiry resolved to the nearest tick
+	# Level n slots each span slots**n ticks; timers cascade down a level as their span comes due
+	# Not thread safe - owned by one loop, which calls advance() and sleeps for next_timeout()
+
+	#############################################################################
+
+	def __init__(self, tick = 0.1, slots = 256, levels = 4, clock = time.monotonic):
+
+		self.tick    = tick
+		self.slots   = slots
+		self.levels  = levels
+		self.clock   = clock
+
+		self._wheels = [[{} for slot in range(slots)] for level in range(levels)]
+		self._spans  = [slots ** level for level in range(levels + 1)]
+		self._now    = int(clock() / tick)		# Last tick processed
+		self._count  = 0
+		self.monitor = None						# Optional LoopMonitor timing each expiry
+
+	#############################################################################
+
+	def __len__(self):
+
+		return self._count
+
+	#############################################################################
+
+	def schedule(self, seconds, callback, *args):
+
+		expiry = max(self._now + 1, math.ceil((self.clock() + seconds) / self.tick))
+
+		timer = WheelTimer(expiry, callback, args)
+
+		self._place(timer)
+
+		self._count += 1
+
+		return timer
+
+	#############################################################################
+
+	def reschedule(self, timer, seconds):
+
+		# Re-arm a fired timer relative to its last expiry so repeating timers do not drift
+
+		if timer.slot is not None:
+
+			self.cancel(timer)
+
+		timer.expiry = max(self._now + 1, timer.expiry + max(1, round(seconds / self.tick)))
+
+		self._place(timer)
+
+		self._count += 1
+
+		return timer
+
+	#############################################################################
+
+	def cancel(self, timer):
+
+		if not isinstance(timer, WheelTimer) or timer.slot is None:
+
+			return False
+
+		del timer.slot[timer]
+
+		timer.slot = None
+
+		self._count -= 1
+
+		return True
+
+	#############################################################################
+
+	def _place(self, timer):
+
+		delta = timer.expiry - self._now
+
+		level = 0
+
+		while level < self.levels - 1 and delta >= self._spans[level + 1]:
+
+			level += 1
+
+		expiry = min(timer.expiry, self._now + self._spans[self.levels] - 1) # beyond range - park in the furthest slot
+
+		timer.slot = self._wheels[level][(expiry // self._spans[level]) % self.slots]
+
+		timer.slot[timer] = None
+
+	#############################################################################
+
+	def next_timeout(self):
+
+		# Seconds until the next tick that could fire or cascade a timer, None when empty
+
+		if not self._count:
+
+			return None
+
+		for tick in range(self._now + 1, self._now + self.slots + 1):
+
+			if self._wheels[0][tick % self.slots] or tick % self.slots == 0:
+
+				break
+
+		return max(0.0, tick * self.tick - self.clock())
+
+	#############################################################################
+
+	def advance(self):
+
+		# Fire every timer due up to the current time - returns the number fired
+
+		target = int(self.clock() / self.tick)
+
+		fired = 0
+
+		while self._now < target:
+
+			if not self._count:
+
+				self._now = target
+
+				break
+
+			self._now += 1
+
+			# Cascade from the highest level due so timers land in slots not yet processed
+
+			for level in reversed(range(1, self.levels)):
+
+				if self._now % self._spans[level] == 0:
+
+					slot = self._wheels[level][(self._now // self._spans[level]) % self.slots]
+
+					timers = list(slot)
+
+					slot.clear()
+
+					for timer in timers:
+
+						self._place(timer)
+
+			slot = self._wheels[0][self._now % self.slots]
+
+			while slot:
+
+				timer = next(iter(slot))
+
+				del slot[timer]
+
+				timer.slot = None
+
+				self._count -= 1
+
+				if self.monitor:
+
+					self.monitor.record_lag(self.clock() - timer.expiry * self.tick)
+
+					self.monitor.call('timer', timer.callback, *timer.args)
+
+				else:
+
+					timer.callback(*timer.args)
+
+				fired += 1
+
+		return fired
+
+################################################################################
+
 class zmqEventLoop(EventLoop):
 
 	_alarm_break = count()
 
+	_alarm_compact_fraction = 0.5		# Rebuild the heap once this fraction of it is cancelled alarms ...
+	_alarm_compact_minimum  = 64		# ... and there are at least this many
+
+	drain_budget = 64					# Most messages a zmq queue handler takes per wakeup before yielding to other sources
+
 	#############################################################################
 
-	def __init__(self):
+	def __init__(self, slow_callback = 0.1, workers = 4, name = 'ui', lanes = 1):
 
 		self._did_something   = True
 		self._alarms          = []
+		self._alarms_live     = set()			# Tie break ids of alarms not yet fired or cancelled
+		self._alarms_dead     = 0				# Cancelled alarms still in the heap
 		self._poller          = zmq.Poller()
 		self._queue_callbacks = {}				# Callback functions
 		self._queue_callbacki = {}				# Index to pass to callback function
+		self._fd_callbacks    = {}				# Callback functions taking (fd, events)
 		self._idle_handle     = 0
 		self._idle_callbacks  = {}
+		self.wheel            = TimingWheel()	# Coarse timers for protocol timeouts
+		self.monitor          = LoopMonitor(name, slow_callback)
+
+		self.wheel.monitor    = self.monitor
+
+		self._workers         = workers
+		self._executor        = None			# Worker pool, started on first use
+		self._lane_count      = max(1, lanes)
+		self._lanes           = []				# Single thread executors for run_ordered, started on first use
+		self._completions     = deque()			# (callback, result, error) waiting for the loop thread
+		self._stopping        = False
+
+		# Pipe written by workers and stop() to wake the poller - created up front so a signal
+		# handler can use it while the loop is blocked in poll
+
+		self._wakeup_r, self._wakeup_w = os.pipe()
+
+		os.set_blocking(self._wakeup_r, False)
+		os.set_blocking(self._wakeup_w, False)
+
+		self.watch_fd(self._wakeup_r, self._on_wakeup)
 
 	#############################################################################
 
@@ -38,24 +263,60 @@ class zmqEventLoop(EventLoop):
 		handle = (time.time() + seconds, next(self._alarm_break), callback)
 
 		heapq.heappush(self._alarms, handle)
-		
+
+		self._alarms_live.add(handle[1])
+
 		return handle
 
 	#############################################################################
 
 	def remove_alarm(self, handle):
 
+		# Cancelled alarms are left in the heap and skipped when they reach the top
+
 		try:
 
-			self._alarms.remove(handle)
+			self._alarms_live.remove(handle[1])
+
+		except (KeyError, TypeError, IndexError):
+
+			return False
+
+		self._alarms_dead += 1
+
+		if self._alarms_dead >= self._alarm_compact_minimum and self._alarms_dead > len(self._alarms) * self._alarm_compact_fraction:
+
+			self._alarms = [alarm for alarm in self._alarms if alarm[1] in self._alarms_live]
 
 			heapq.heapify(self._alarms)
 
-			return True
+			self._alarms_dead = 0
 
-		except ValueError:
+		return True
 
-			return False
+	#############################################################################
+
+	def _purge_alarms(self):
+
+		while self._alarms and self._alarms[0][1] not in self._alarms_live:
+
+			heapq.heappop(self._alarms)
+
+			self._alarms_dead -= 1
+
+	#############################################################################
+
+	def set_timeout(self, seconds, callback, *args):
+
+		# Coarse timer on the timing wheel - cheap to schedule and cancel in large numbers
+
+		return self.wheel.schedule(seconds, callback, *args)
+
+	#############################################################################
+
+	def cancel_timeout(self, handle):
+
+		return self.wheel.cancel(handle)
 
 	#############################################################################
 
@@ -74,6 +335,27 @@ class zmqEventLoop(EventLoop):
 
 	#############################################################################
 
+	def drain_queue(self, queue, budget = None):
+
+		# Receive everything queued on a zmq socket without blocking, up to the budget
+		# Anything left keeps the socket readable so the poller returns to it on the next pass
+
+		messages = []
+
+		for _ in range(budget or self.drain_budget):
+
+			try:
+
+				messages.append(queue.recv_multipart(zmq.DONTWAIT))
+
+			except zmq.Again:
+
+				break
+
+		return messages
+
+	#############################################################################
+
 	def remove_watch_queue(self, handle):
 
 		try:
@@ -131,6 +413,191 @@ class zmqEventLoop(EventLoop):
 
 	#############################################################################
 
+	def watch_fd(self, fd, callback, flags=zmq.POLLIN):
+
+		# Watch a raw file descriptor, passing the ready events to callback(fd, events)
+		# Watching an already watched fd updates its flags
+
+		self._poller.register(fd, flags)
+
+		self._fd_callbacks[fd] = callback
+
+		return fd
+
+	#############################################################################
+
+	def remove_watch_fd(self, handle):
+
+		if handle not in self._fd_callbacks:
+
+			return False
+
+		del self._fd_callbacks[handle]
+
+		try:
+
+			self._poller.unregister(handle)
+
+		except KeyError:
+
+			pass
+
+		return True
+
+	#############################################################################
+
+	def run_in_worker(self, callback, function, *args):
+
+		# Run a blocking function on the worker pool - callback(result, error) is called on the loop thread
+
+		if self._executor is None:
+
+			self._executor = ThreadPoolExecutor(max_workers = self._workers, thread_name_prefix = 'loop-worker')
+
+		self._executor.submit(self._work, callback, function, args)
+
+	#############################################################################
+
+	def run_ordered(self, key, callback, function, *args):
+
+		# As run_in_worker, but work sharing a key runs in submission order on one lane
+		# while work for different keys runs in parallel across the lanes
+
+		if not self._lanes:
+
+			self._lanes = [ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'loop-lane') for lane in range(self._lane_count)]
+
+		self._lanes[zlib.crc32(key.encode()) % len(self._lanes)].submit(self._work, callback, function, args)
+
+	#############################################################################
+
+	def _work(self, callback, function, args):
+
+		# Worker thread - queue the outcome for the loop thread and wake it
+
+		try:
+
+			result = (callback, function(*args), None)
+
+		except Exception as error:
+
+			result = (callback, None, error)
+
+		self._completions.append(result)
+
+		self._wakeup()
+
+	#############################################################################
+
+	def _wakeup(self):
+
+		if self._wakeup_w is None:
+
+			return # Pipe released by shutdown_workers()
+
+		try:
+
+			os.write(self._wakeup_w, b'\0')
+
+		except BlockingIOError:
+
+			pass # Pipe already full - the loop is certain to wake
+
+	#############################################################################
+
+	def stop(self):
+
+		# Exit run() from the loop thread - safe to call from a signal handler or another thread
+
+		self._stopping = True
+
+		self._wakeup()
+
+	#############################################################################
+
+	def _on_wakeup(self, fd, events):
+
+		try:
+
+			while os.read(fd, 4096):
+
+				pass
+
+		except BlockingIOError:
+
+			pass
+
+		while self._completions:
+
+			callback, result, error = self._completions.popleft()
+
+			self.monitor.call('worker', callback, result, error)
+
+		if self._stopping:
+
+			self._stopping = False
+
+			raise urwid.ExitMainLoop()
+
+	#############################################################################
+
+	def shutdown_workers(self):
+
+		# Wait for running work, deliver what completed and release the wakeup pipe
+		# Completion callbacks may queue follow on work, so repeat until everything has settled
+
+		while self._executor or self._lanes or self._completions:
+
+			executors, self._executor, self._lanes = [self._executor] + self._lanes, None, []
+
+			for executor in executors:
+
+				if executor is not None:
+
+					executor.shutdown(wait = True)
+
+			while self._completions:
+
+				callback, result, error = self._completions.popleft()
+
+				self.monitor.call('worker', callback, result, error)
+
+		if self._wakeup_w is not None:
+
+			self.remove_watch_fd(self._wakeup_r)
+
+			os.close(self._wakeup_r)
+			os.close(self._wakeup_w)
+
+			self._wakeup_r = None
+			self._wakeup_w = None
+
+	#############################################################################
+
+	def set_interval(self, seconds, callback, *args):
+
+		# Repeating timer on the wheel - the handle stays valid across re-arms for cancel_interval()
+
+		handle = [None]
+
+		def repeat():
+
+			self.wheel.reschedule(handle[0], seconds)
+
+			callback(*args)
+
+		handle[0] = self.wheel.schedule(seconds, repeat)
+
+		return handle
+
+	#############################################################################
+
+	def cancel_interval(self, handle):
+
+		return self.wheel.cancel(handle[0])
+
+	#############################################################################
+
 	def enter_idle(self, callback):
 
 		self._idle_handle += 1
@@ -159,7 +626,7 @@ class zmqEventLoop(EventLoop):
 
 		for callback in list(self._idle_callbacks.values()):
 
-			callback()
+			self.monitor.call('idle', callback)
 
 	#############################################################################
 
@@ -187,15 +654,29 @@ class zmqEventLoop(EventLoop):
 
 	def _loop(self):
 
-		if self._alarms or self._did_something:
+		self._purge_alarms()
+
+		if self.wheel.advance():
+
+			self._did_something = True
+
+		wheel_timeout = self.wheel.next_timeout()
+
+		if self._alarms or self._did_something or wheel_timeout is not None:
+
+			state   = 'wheel'
+			timeout = wheel_timeout
 
 			if self._alarms:
 
-				state = 'alarm'
+				alarm_timeout = max(0, self._alarms[0][0] - time.time())
+
+				if timeout is None or alarm_timeout <= timeout:
 
-				timeout = max(0, self._alarms[0][0] - time.time())
+					state   = 'alarm'
+					timeout = alarm_timeout
 
-			if self._did_something and (not self._alarms or (self._alarms and timeout > 0)):
+			if self._did_something and (timeout is None or timeout > 0):
 
 				state = 'idle'
 
@@ -221,19 +702,35 @@ class zmqEventLoop(EventLoop):
 
 				due, tie_break, callback = heapq.heappop(self._alarms)
 
-				callback()
+				self._alarms_live.discard(tie_break)
+
+				self.monitor.record_lag(time.time() - due)
+
+				self.monitor.call('alarm', callback)
 
 				self._did_something = True
 
-		for queue, _ in ready.items():
+		for queue, events in ready.items():
+
+			if queue == self._wakeup_r:
+
+				self._on_wakeup(queue, events)											# Untimed - times each worker callback itself
+
+			elif queue in self._fd_callbacks:
+
+				self.monitor.call('fd', self._fd_callbacks[queue], queue, events)		# Call for raw fd with ready events
+
+			elif queue not in self._queue_callbacki:
+
+				continue														# Removed by an earlier callback
 
-			if self._queue_callbacki[queue] == zmq_magic:						# Default value used for back compatibility
+			elif self._queue_callbacki[queue] == zmq_magic:						# Default value used for back compatibility
 
-				self._queue_callbacks[queue]()									# Call for urwid file descriptor
+				self.monitor.call('input', self._queue_callbacks[queue])				# Call for urwid file descriptor
 
 			else:
 
-				self._queue_callbacks[queue](self._queue_callbacki[queue])		# Call for zmq queue
+				self.monitor.call('queue', self._queue_callbacks[queue], self._queue_callbacki[queue])	# Call for zmq queue
 
 			self._did_something = True
 